@@ -1,15 +1,99 @@
 from chromadb import PersistentClient
+from chromadb.errors import NotFoundError
 from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction
+from app.core.embeddings import CachedEmbeddingFunction
+from app.core.openai_client import sync_client
 import os
+import re
+import threading
 from dotenv import load_dotenv
 load_dotenv()
-chroma_client = PersistentClient(path="data/chroma")
-embedding_function = OpenAIEmbeddingFunction(
-    api_key=os.environ.get("OPENAI_API_KEY"),
-    model_name="text-embedding-3-small"
-)
-
-conversation_collection = chroma_client.get_or_create_collection(
-    name="conversation_chunks",
-    embedding_function=embedding_function
-)
+
+CHROMA_PATH = os.environ.get("CHROMA_PATH", "data/chroma")
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Facts written before properties existed live in the original collection,
+# which now belongs to this property.
+DEFAULT_PROPERTY_ID = "default"
+PROPERTY_ID_PATTERN = re.compile(r"^[A-Za-z0-9](?:[A-Za-z0-9_-]{0,61}[A-Za-z0-9])?$")
+
+# One client, one embedding function and one collection per process, created
+# on first use (or by warm_up() from the application lifespan) instead of at import.
+_lock = threading.Lock()
+_chroma_client = None
+_embedding_function = None
+_property_collections = {}
+
+def get_embedding_function() -> CachedEmbeddingFunction:
+    global _embedding_function
+    if _embedding_function is None:
+        with _lock:
+            if _embedding_function is None:
+                remote = OpenAIEmbeddingFunction(
+                    api_key=os.environ.get("OPENAI_API_KEY"),
+                    model_name=EMBEDDING_MODEL
+                )
+                # Send its requests through the shared pooled client instead of its own.
+                remote.client = sync_client
+                # Every query_texts/documents embedding goes through the cache first.
+                _embedding_function = CachedEmbeddingFunction(remote, model_name=EMBEDDING_MODEL)
+    return _embedding_function
+
+def get_chroma_client() -> PersistentClient:
+    global _chroma_client
+    if _chroma_client is None:
+        with _lock:
+            if _chroma_client is None:
+                _chroma_client = PersistentClient(path=CHROMA_PATH)
+    return _chroma_client
+
+def is_valid_property_id(property_id: str) -> bool:
+    return isinstance(property_id, str) and bool(PROPERTY_ID_PATTERN.match(property_id))
+
+def property_collection_name(property_id: str) -> str:
+    if property_id == DEFAULT_PROPERTY_ID:
+        return "conversation_chunks"
+    return f"property-{property_id}"
+
+def scoped_key(property_id: str, key: str) -> str:
+    """
+    Key for per-property knowledge versions and caches, "kv:{property}:{key}".
+    Property ids contain no ":", and other keys in the versions table use
+    their own prefix, so no two properties or key kinds can collide.
+    """
+    return f"kv:{property_id}:{key}"
+
+def get_property_collection(property_id: str = DEFAULT_PROPERTY_ID, create: bool = True):
+    """
+    The property's own collection, so retrieval only ever searches that
+    property's facts and its cost doesn't grow with the number of properties.
+    Only writers create it: with `create=False` a property that has no
+    collection yet gets None, so reads for arbitrary ids leave nothing on disk.
+    """
+    collection = _property_collections.get(property_id)
+    if collection is None:
+        client = get_chroma_client()
+        embedding_function = get_embedding_function()
+        with _lock:
+            collection = _property_collections.get(property_id)
+            if collection is None:
+                name = property_collection_name(property_id)
+                if create:
+                    collection = client.get_or_create_collection(name=name, embedding_function=embedding_function)
+                else:
+                    try:
+                        collection = client.get_collection(name=name, embedding_function=embedding_function)
+                    except NotFoundError:
+                        return None
+                _property_collections[property_id] = collection
+    return collection
+
+def get_conversation_collection():
+    return get_property_collection(DEFAULT_PROPERTY_ID)
+
+def embed_texts(texts: list) -> list:
+    return get_embedding_function()(texts)
+
+def warm_up():
+    """Open the client and collection ahead of the first request."""
+    collection = get_conversation_collection()
+    collection.count()
@@ -0,0 +1,132 @@
+# app/core/embeddings.py
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from chromadb import Documents, EmbeddingFunction, Embeddings
+from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction
+
+from app.core.tracing import traced_call
+
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "data/embeddings.db")
+EMBEDDING_CACHE_MEMORY_ITEMS = int(os.environ.get("EMBEDDING_CACHE_MEMORY_ITEMS", "10000"))
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Two-tier cache in front of a remote embedding function.
+
+    Vectors are keyed on (model, normalized text). Lookups go to an in-memory
+    LRU first, then to a SQLite table of float32 blobs, and only the texts
+    missing from both are sent to the wrapped function, in a single batch.
+    The wrapper reports the wrapped function's name and config so existing
+    Chroma collections accept it.
+    """
+
+    def __init__(self, inner: EmbeddingFunction, model_name: str,
+                 cache_path: str = EMBEDDING_CACHE_PATH,
+                 max_memory_items: int = EMBEDDING_CACHE_MEMORY_ITEMS):
+        self.inner = inner
+        self.model_name = model_name
+        self.max_memory_items = max_memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(cache_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._db.commit()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def __call__(self, input: Documents) -> Embeddings:
+        keys = [self._key(text) for text in input]
+        vectors = [None] * len(input)
+        pending = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    vectors[i] = vector
+                    self.memory_hits += 1
+                else:
+                    pending.setdefault(key, []).append(i)
+
+            if pending:
+                placeholders = ",".join("?" * len(pending))
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", list(pending)
+                ).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    self._remember(key, vector)
+                    for i in pending.pop(key):
+                        vectors[i] = vector
+                        self.disk_hits += 1
+
+        if pending:
+            # One remote request for every text missing from both tiers.
+            missing_keys = list(pending)
+            fresh = traced_call("embedding.remote", self.inner, [input[pending[key][0]] for key in missing_keys])
+            with self._lock:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, np.asarray(vector, dtype=np.float32).tobytes())
+                     for key, vector in zip(missing_keys, fresh)],
+                )
+                self._db.commit()
+                for key, vector in zip(missing_keys, fresh):
+                    vector = np.asarray(vector, dtype=np.float32)
+                    self._remember(key, vector)
+                    for i in pending[key]:
+                        vectors[i] = vector
+                        self.misses += 1
+        return vectors
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_items": len(self._memory),
+                "hit_rate": (self.memory_hits + self.disk_hits) / total if total else 0.0,
+            }
+
+    @staticmethod
+    def name() -> str:
+        # Collections persisted with OpenAIEmbeddingFunction record this name.
+        return OpenAIEmbeddingFunction.name()
+
+    def get_config(self):
+        return self.inner.get_config()
+
+    @staticmethod
+    def build_from_config(config):
+        inner = OpenAIEmbeddingFunction.build_from_config(config)
+        return CachedEmbeddingFunction(inner, model_name=config.get("model_name"))
+
+    def default_space(self):
+        return self.inner.default_space()
+
+    def supported_spaces(self):
+        return self.inner.supported_spaces()
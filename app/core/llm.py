@@ -1,15 +1,29 @@
 # app/core/llm.py
 import os
 import json
-from openai import OpenAI
 from app.logger import logger
 from app.helpers.helpers import log_llm_input
+from app.helpers.classifier import ALLOWED_ATTRIBUTES, DEFAULT_ATTRIBUTE
+from app.core.tracing import traced, record_usage, stage_latency
+from app.core.openai_client import async_client
+import time
 from dotenv import load_dotenv
 load_dotenv()
 
-client = OpenAI(api_key = os.environ.get("OPENAI_API_KEY"))
+# Shared pooled client with timeouts, retries, circuit breaker and fallback model.
+client = async_client
 
-def call_openai_should_save(message: str, recent_messages: list, history: str = ""):
+# Tenant pipeline modes, selectable per deployment to A/B the round-trip count:
+#   TENANT_ROUTER_MODE=separate  should_answer + attribute inference as separate steps
+#   TENANT_ROUTER_MODE=fused     one structured call returning both (call_openai_route_message)
+#   TENANT_ANSWER_MODE=separate  relevance check, then RAG answer
+#   TENANT_ANSWER_MODE=fused     one structured call returning both (call_openai_answer_with_relevance)
+TENANT_ROUTER_MODE = os.environ.get("TENANT_ROUTER_MODE", "separate").lower()
+TENANT_ANSWER_MODE = os.environ.get("TENANT_ANSWER_MODE", "separate").lower()
+FUSED_MODEL = os.environ.get("FUSED_MODEL", "gpt-4o-mini")
+
+@traced("llm.should_save")
+async def call_openai_should_save(message: str, recent_messages: list):
     system_prompt = """
 You are an assistant that decides whether a message from the PROPERTY OWNER should be saved for future reference by an AI assistant.
 
@@ -20,13 +34,15 @@ You will be given:
 Your task is to:
 1. Determine whether the owner has confirmed or denied or provided specific, factual, and actionable information about the property in their current message, based on the context in recent_messages.
 2. If yes, reconstruct the confirmed information as a complete, standalone factual sentence. You must infer it from the context, but do not hallucinate or assume beyond what is clearly implied.
-3. If no property-related fact is confirmed, choose "ignore".
+3. Name the specific sub-topic the fact settles as a short snake_case label (for example "monthly_rent", "pet_policy", "parking", "heating"). A later fact with the same topic replaces this one, so use the same label for facts that answer the same question and different labels for independent facts.
+4. If no property-related fact is confirmed, choose "ignore".
 
 Respond strictly in this JSON format:
 {
   "action": "save" | "ignore",
   "reason": "...",
-  "content_to_save": "..."  // A clear, factual statement if saving, otherwise empty
+  "content_to_save": "...",  // A clear, factual statement if saving, otherwise empty
+  "topic": "..."  // The sub-topic label if saving, otherwise empty
 }
 """
     user_input = {
@@ -34,40 +50,72 @@ Respond strictly in this JSON format:
         "recent_messages": recent_messages,
     }
     log_llm_input("should_save()", user_input)
-    response = client.chat.completions.create(
+    response = await client.chat.completions.create(
         model="o3-mini",
         messages=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": json.dumps(user_input)}
         ]
     )
-    logger.info(f"[LLM] Raw should_save() response: {response.choices[0].message.content}")
+    record_usage("llm.should_save", response)
+    logger.debug("[LLM] Raw should_save() response: %s", response.choices[0].message.content)
     return json.loads(response.choices[0].message.content)
 
-def call_openai_rag(query: str, context: str) -> str:
-    system_prompt = """
+RAG_SYSTEM_PROMPT = """
  You are a helpful assistant for a property rental platform.
  Treat each line of context as the current snapshot of the property.
  Answer exactly what the tenant asks—do not volunteer any other details.
  Be brief, friendly, and use only the relevant fact from the context.
  """
 
-    messages = [
-        {"role": "system", "content": system_prompt},
+def rag_messages(query: str, context: str) -> list:
+    return [
+        {"role": "system", "content": RAG_SYSTEM_PROMPT},
         {"role": "user", "content": f"Tenant's question: {query}\n\nContext:\n{context}"}
     ]
-    response = client.chat.completions.create(
+
+@traced("llm.rag")
+async def call_openai_rag(query: str, context: str) -> str:
+    messages = rag_messages(query, context)
+    response = await client.chat.completions.create(
         model="gpt-4o-mini",
         messages=messages,
     )
-    logger.info(f"[LLM] Raw RAG response: {response.choices[0].message.content}")
+    record_usage("llm.rag", response)
+    logger.debug("[LLM] Raw RAG response: %s", response.choices[0].message.content)
     return response.choices[0].message.content
 
-def call_openai_should_answer(message: str, history: str = ""):
+@traced("llm.rag_stream")
+async def call_openai_rag_stream(query: str, context: str):
+    """Same prompt as call_openai_rag, yielding answer tokens as they arrive."""
+    messages = rag_messages(query, context)
+    started = time.perf_counter()
+    first_token = True
+    stream = await client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    async for chunk in stream:
+        # With include_usage the last chunk carries token counts and no choices.
+        if getattr(chunk, "usage", None) is not None:
+            record_usage("llm.rag_stream", chunk)
+        if not chunk.choices:
+            continue
+        token = chunk.choices[0].delta.content
+        if token:
+            if first_token:
+                stage_latency.observe(time.perf_counter() - started, stage="llm.rag_stream.first_token", status="ok")
+                first_token = False
+            yield token
+
+@traced("llm.should_answer")
+async def call_openai_should_answer(message: str, history: dict = None):
     system_prompt = """
 You are an assistant that decides whether a tenant's message should be processed using RAG (retrieval-augmented generation).
 Only return 'true' if the message contains a clear question or request that may require stored information.
-resonate with the conversation history {history}
+resonate with the conversation history: a summary of older turns plus the most recent turns.
 Respond in JSON like this:
 {
   "answer": true | false,
@@ -76,20 +124,22 @@ Respond in JSON like this:
 """
     user_input = {
         "message": message,
-        "conversation_history": history
+        "conversation_history": history or {}
     }
     log_llm_input("should_answer()", user_input)
-    response = client.chat.completions.create(
+    response = await client.chat.completions.create(
         model="o3-mini",
         messages=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": json.dumps(user_input)}
         ]
     )
-    logger.info(f"[LLM] Raw should_answer() response: {response.choices[0].message.content}")
+    record_usage("llm.should_answer", response)
+    logger.debug("[LLM] Raw should_answer() response: %s", response.choices[0].message.content)
     return json.loads(response.choices[0].message.content)
 
-def call_openai_check_relevance(query: str, context: str) -> dict:
+@traced("llm.check_relevance")
+async def call_openai_check_relevance(query: str, context: str) -> dict:
     system_prompt = """
 You are an assistant that determines if retrieved documents are SPECIFICALLY relevant enough to answer a tenant's question about a rental property.
 
@@ -117,7 +167,7 @@ Important: Verify that the documents SPECIFICALLY and EXPLICITLY address the que
 Generic responses without clear context are not considered relevant.
 """
     log_llm_input("check_relevance()", {"query": query, "context": context})
-    response = client.chat.completions.create(
+    response = await client.chat.completions.create(
         model="o3-mini",
         messages=[
             {"role": "system", "content": system_prompt},
@@ -125,5 +175,150 @@ Generic responses without clear context are not considered relevant.
         ],
         response_format={"type": "json_object"},
     )
-    logger.info(f"[LLM] Raw relevance check response: {response.choices[0].message.content}")
+    record_usage("llm.check_relevance", response)
+    logger.debug("[LLM] Raw relevance check response: %s", response.choices[0].message.content)
+    return json.loads(response.choices[0].message.content)
+
+@traced("llm.summarize_history")
+async def call_openai_summarize_history(previous_summary: str, turns: list) -> str:
+    system_prompt = """
+You maintain a running summary of a conversation between a tenant, a property owner and an assistant.
+You will be given the summary so far and the turns that happened after it.
+Produce an updated summary that keeps every question, answer and property fact that may matter later.
+Be concise: a few short sentences, no preamble.
+"""
+    user_input = {
+        "summary_so_far": previous_summary,
+        "new_turns": turns,
+    }
+    log_llm_input("summarize_history()", user_input)
+    response = await client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": json.dumps(user_input)}
+        ],
+        temperature=0.0
+    )
+    record_usage("llm.summarize_history", response)
+    logger.debug("[LLM] Raw summarize_history() response: %s", response.choices[0].message.content)
+    return response.choices[0].message.content.strip()
+
+@traced("llm.label_topics")
+async def call_openai_label_topics(groups: list) -> list:
+    """
+    `groups` is [(known_topics, facts)], one per attribute; returns one list
+    of topics per group, in order.
+    """
+    system_prompt = """
+You label facts about a rental property with the specific sub-topic each one settles.
+The facts come in groups; each group belongs to one property attribute and lists the labels already in use for it as known_topics.
+Give every fact a short snake_case label (for example "monthly_rent", "pet_policy", "parking", "heating").
+Within a group, a newer fact with the same label replaces an older one, so facts that answer the same question must share a label and independent facts must not.
+Reuse a label from the group's known_topics whenever a fact answers the same question as that label.
+Respond in JSON like this, with one list per group and one label per fact, in order:
+{"topics": [["monthly_rent", "pet_policy"], ["parking"]]}
+"""
+    user_input = {
+        "groups": [{"known_topics": known_topics, "facts": facts} for known_topics, facts in groups],
+    }
+    log_llm_input("label_topics()", user_input)
+    response = await client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": json.dumps(user_input)}
+        ],
+        response_format={"type": "json_object"},
+        temperature=0.0
+    )
+    record_usage("llm.label_topics", response)
+    logger.debug("[LLM] Raw label_topics() response: %s", response.choices[0].message.content)
+    return json.loads(response.choices[0].message.content).get("topics", [])
+
+@traced("llm.route_message")
+async def call_openai_route_message(message: str, history: dict = None) -> dict:
+    """Fused should_answer + attribute inference in one schema-constrained call."""
+    system_prompt = """
+You are the router for a property rental assistant. For the tenant's latest message decide:
+1. answer: true only if the message contains a clear question or request that may require stored information about the property.
+2. attribute: the primary feature axis the message is about, one of the allowed values. Use 'general' only if none of the specific features apply.
+Take the conversation history (a summary of older turns plus the most recent turns) into account.
+"""
+    user_input = {
+        "message": message,
+        "conversation_history": history or {}
+    }
+    log_llm_input("route_message()", user_input)
+    response = await client.chat.completions.create(
+        model=FUSED_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": json.dumps(user_input)}
+        ],
+        response_format={
+            "type": "json_schema",
+            "json_schema": {
+                "name": "tenant_route",
+                "strict": True,
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "answer": {"type": "boolean"},
+                        "attribute": {"type": "string", "enum": ALLOWED_ATTRIBUTES + [DEFAULT_ATTRIBUTE]},
+                        "reason": {"type": "string"}
+                    },
+                    "required": ["answer", "attribute", "reason"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        temperature=0.0
+    )
+    record_usage("llm.route_message", response)
+    logger.debug("[LLM] Raw route_message() response: %s", response.choices[0].message.content)
+    route = json.loads(response.choices[0].message.content)
+    if route.get("attribute") not in ALLOWED_ATTRIBUTES:
+        route["attribute"] = DEFAULT_ATTRIBUTE
+    return route
+
+@traced("llm.answer_with_relevance")
+async def call_openai_answer_with_relevance(query: str, context: str) -> dict:
+    """Fused relevance check + RAG answer in one schema-constrained call."""
+    system_prompt = """
+You are a helpful assistant for a property rental platform.
+First decide, strictly, whether the retrieved documents EXPLICITLY address the specific topic of the tenant's question.
+Generic documents without clear context are not relevant.
+If they are relevant, answer exactly what the tenant asks using only the relevant fact from the documents: brief, friendly, nothing volunteered.
+Treat each line of context as the current snapshot of the property.
+If they are not relevant, leave the answer empty.
+"""
+    user_input = f"Tenant's question: {query}\n\nRetrieved documents:\n{context}"
+    log_llm_input("answer_with_relevance()", {"query": query, "context": context})
+    response = await client.chat.completions.create(
+        model=FUSED_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_input}
+        ],
+        response_format={
+            "type": "json_schema",
+            "json_schema": {
+                "name": "tenant_answer",
+                "strict": True,
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "is_relevant": {"type": "boolean"},
+                        "reason": {"type": "string"},
+                        "answer": {"type": "string"}
+                    },
+                    "required": ["is_relevant", "reason", "answer"],
+                    "additionalProperties": False
+                }
+            }
+        }
+    )
+    record_usage("llm.answer_with_relevance", response)
+    logger.debug("[LLM] Raw answer_with_relevance() response: %s", response.choices[0].message.content)
     return json.loads(response.choices[0].message.content)
@@ -0,0 +1,243 @@
+# app/core/openai_client.py
+import asyncio
+import os
+import random
+import threading
+import time
+import types
+import weakref
+
+import httpx
+import openai
+from dotenv import load_dotenv
+
+from app.logger import logger
+
+load_dotenv()
+
+OPENAI_TIMEOUT_SECONDS = float(os.environ.get("OPENAI_TIMEOUT_SECONDS", "30"))
+OPENAI_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("OPENAI_CONNECT_TIMEOUT_SECONDS", "5"))
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "3"))
+OPENAI_RETRY_BASE_SECONDS = float(os.environ.get("OPENAI_RETRY_BASE_SECONDS", "0.5"))
+OPENAI_RETRY_MAX_SECONDS = float(os.environ.get("OPENAI_RETRY_MAX_SECONDS", "8"))
+# Requests in flight at once per process (per client), to stay under rate limits.
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "32"))
+# Consecutive failures that open a model's circuit, and how long it stays open.
+OPENAI_CIRCUIT_FAILURES = int(os.environ.get("OPENAI_CIRCUIT_FAILURES", "5"))
+OPENAI_CIRCUIT_RESET_SECONDS = float(os.environ.get("OPENAI_CIRCUIT_RESET_SECONDS", "30"))
+# Cheaper model used when the requested one is slower than the budget below,
+# failing, or has an open circuit. Empty disables the fallback.
+OPENAI_FALLBACK_MODEL = os.environ.get("OPENAI_FALLBACK_MODEL", "")
+OPENAI_FALLBACK_AFTER_SECONDS = float(os.environ.get("OPENAI_FALLBACK_AFTER_SECONDS", "10"))
+
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calling a model after `failure_threshold` consecutive failures.
+    After `reset_seconds` one trial call is let through; its outcome closes
+    or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = OPENAI_CIRCUIT_FAILURES,
+                 reset_seconds: float = OPENAI_CIRCUIT_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_seconds:
+                # Half-open: this caller is the trial, everyone else waits for it.
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"[OpenAI] Circuit opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+
+# Shared by the async and sync clients, keyed by model.
+_breakers = {}
+_breakers_lock = threading.Lock()
+_events = {"retry": 0, "fallback": 0, "circuit_rejected": 0, "failure": 0}
+
+
+def breaker_for(model: str) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(model)
+        if breaker is None:
+            breaker = _breakers[model] = CircuitBreaker()
+        return breaker
+
+
+def _count(event: str):
+    with _breakers_lock:
+        _events[event] += 1
+
+
+def stats() -> dict:
+    with _breakers_lock:
+        return {
+            "events": dict(_events),
+            "open_circuits": {model: int(b.is_open) for model, b in _breakers.items()},
+        }
+
+
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff with jitter, so retries from concurrent requests spread out."""
+    delay = min(OPENAI_RETRY_MAX_SECONDS, OPENAI_RETRY_BASE_SECONDS * 2 ** attempt)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(OPENAI_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS)
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS)
+
+
+class ResilientAsyncOpenAI:
+    """
+    Shared async OpenAI client: one keep-alive connection pool, a default
+    timeout (callers may pass `timeout=` per call), a concurrency cap, jittered
+    retries of transient errors, a circuit breaker per model and an optional
+    fallback model. Exposes `chat.completions.create` like AsyncOpenAI, so call
+    sites don't change. `inner` is the client actually called.
+    """
+
+    def __init__(self, inner=None):
+        self.inner = inner or openai.AsyncOpenAI(
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            timeout=_timeout(),
+            max_retries=0,  # retried here, with jitter and the circuit breaker
+            http_client=openai.DefaultAsyncHttpxClient(timeout=_timeout(), limits=_limits()),
+        )
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create_chat_completion))
+        # asyncio primitives belong to one event loop; keep one per loop.
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+        return semaphore
+
+    async def create_chat_completion(self, **kwargs):
+        model = kwargs.get("model")
+        fallback = OPENAI_FALLBACK_MODEL if OPENAI_FALLBACK_MODEL and OPENAI_FALLBACK_MODEL != model else None
+        try:
+            return await self._call(kwargs, budget=OPENAI_FALLBACK_AFTER_SECONDS if fallback else None)
+        except (CircuitOpenError, asyncio.TimeoutError) + RETRYABLE_ERRORS as e:
+            if fallback is None:
+                raise
+            logger.warning(f"[OpenAI] {model} unavailable ({type(e).__name__}); falling back to {fallback}")
+            _count("fallback")
+            return await self._call(dict(kwargs, model=fallback))
+
+    async def _call(self, kwargs: dict, budget: float = None):
+        model = kwargs.get("model")
+        breaker = breaker_for(model)
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            if not breaker.allow():
+                _count("circuit_rejected")
+                raise CircuitOpenError(f"Circuit open for model {model}")
+            try:
+                async with self._semaphore():
+                    request = self.inner.chat.completions.create(**kwargs)
+                    response = await (asyncio.wait_for(request, budget) if budget else request)
+            except asyncio.TimeoutError:
+                # Slower than the fallback budget; the caller switches model.
+                breaker.record_failure()
+                raise
+            except RETRYABLE_ERRORS as e:
+                breaker.record_failure()
+                if attempt == OPENAI_MAX_RETRIES:
+                    _count("failure")
+                    raise
+                delay = retry_delay(attempt)
+                _count("retry")
+                logger.warning(f"[OpenAI] {model} call failed ({type(e).__name__}); retry {attempt + 1} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            breaker.record_success()
+            return response
+
+
+class ResilientOpenAI:
+    """
+    Synchronous counterpart for embeddings (Chroma calls embedding functions
+    from worker threads): same pool settings, retries and circuit breaker.
+    Exposes `embeddings.create` like openai.OpenAI.
+    """
+
+    def __init__(self, inner=None):
+        self.inner = inner or openai.OpenAI(
+            api_key=os.environ.get("OPENAI_API_KEY"),
+            timeout=_timeout(),
+            max_retries=0,
+            http_client=openai.DefaultHttpxClient(timeout=_timeout(), limits=_limits()),
+        )
+        self.embeddings = types.SimpleNamespace(create=self.create_embeddings)
+        self._semaphore = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+
+    def create_embeddings(self, **kwargs):
+        model = kwargs.get("model")
+        breaker = breaker_for(model)
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            if not breaker.allow():
+                _count("circuit_rejected")
+                raise CircuitOpenError(f"Circuit open for model {model}")
+            try:
+                with self._semaphore:
+                    response = self.inner.embeddings.create(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                breaker.record_failure()
+                if attempt == OPENAI_MAX_RETRIES:
+                    _count("failure")
+                    raise
+                delay = retry_delay(attempt)
+                _count("retry")
+                logger.warning(f"[OpenAI] {model} call failed ({type(e).__name__}); retry {attempt + 1} in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            breaker.record_success()
+            return response
+
+
+# The process-wide clients; every OpenAI call in the app goes through these.
+async_client = ResilientAsyncOpenAI()
+sync_client = ResilientOpenAI()
@@ -0,0 +1,228 @@
+# app/core/request_guard.py
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Reverse proxies in front of the app that append to X-Forwarded-For. 0 uses
+# the socket peer address and ignores the header, which clients can forge.
+# The Procfile sets 1 for the platform router.
+RATE_LIMIT_TRUSTED_PROXIES = int(os.environ.get("RATE_LIMIT_TRUSTED_PROXIES", "0"))
+# Token buckets: sustained requests per minute and burst size. A rate of 0
+# disables that limit. Behind an unconfigured proxy every client has the
+# proxy's address, so the per-IP limit is off by default without trusted proxies.
+RATE_LIMIT_USER_PER_MINUTE = float(os.environ.get("RATE_LIMIT_USER_PER_MINUTE", "30"))
+RATE_LIMIT_USER_BURST = float(os.environ.get("RATE_LIMIT_USER_BURST", "10"))
+RATE_LIMIT_IP_PER_MINUTE = float(os.environ.get(
+    "RATE_LIMIT_IP_PER_MINUTE", "120" if RATE_LIMIT_TRUSTED_PROXIES > 0 else "0"
+))
+RATE_LIMIT_IP_BURST = float(os.environ.get("RATE_LIMIT_IP_BURST", "30"))
+# Buckets kept per limiter; the least recently used are dropped first.
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "100000"))
+
+# How long the response to an Idempotency-Key is replayed, and how long an
+# identical request without one (a double click) gets the same response.
+IDEMPOTENCY_TTL_SECONDS = float(os.environ.get("IDEMPOTENCY_TTL_SECONDS", "600"))
+DUPLICATE_WINDOW_SECONDS = float(os.environ.get("DUPLICATE_WINDOW_SECONDS", "5"))
+IDEMPOTENCY_MAX_ITEMS = int(os.environ.get("IDEMPOTENCY_MAX_ITEMS", "10000"))
+# A request still running after this long is presumed lost (e.g. a stream
+# whose client left before it started); repeats run again instead of waiting.
+IDEMPOTENCY_IN_FLIGHT_SECONDS = float(os.environ.get("IDEMPOTENCY_IN_FLIGHT_SECONDS", "300"))
+
+
+class IdempotencyKeyReused(Exception):
+    """An Idempotency-Key was sent again with a different request."""
+
+
+class OriginalRequestFailed(Exception):
+    """The request a repeat was waiting on failed or was abandoned; the repeat may retry."""
+
+
+class TokenBucketLimiter:
+    """
+    One token bucket per key, refilled continuously at `rate_per_minute` up
+    to `burst`. Buckets live in this process, so with several workers each
+    enforces the limit on the requests it receives.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(burst, 1.0)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def acquire(self, key: str, cost: float = 1.0) -> float:
+        """Take `cost` tokens for `key`. Returns 0.0, or the seconds until they are available."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0.0
+            else:
+                wait = (cost - tokens) / self.rate
+                self.limited += 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class RequestCoalescer:
+    """
+    Runs each request key once. Concurrent requests with the same key wait
+    for the first one's response instead of running the pipeline again, and
+    requests arriving within `ttl` after it finished get the stored response.
+    A request that fails is forgotten, so a retry runs again.
+    Like the limiter, this only sees the requests of its own process.
+    """
+
+    def __init__(self, max_items: int = IDEMPOTENCY_MAX_ITEMS):
+        self.max_items = max_items
+        self._in_flight = {}
+        self._done = OrderedDict()
+        self.coalesced = 0
+        self.replayed = 0
+
+    def lookup(self, key: str):
+        """
+        ("done", (fingerprint, response)), ("in_flight", (fingerprint, future,
+        started)) or (None, None) when the key is new.
+        """
+        entry = self._done.get(key)
+        if entry is not None:
+            expires_at, fingerprint, response = entry
+            if time.monotonic() < expires_at:
+                self.replayed += 1
+                return "done", (fingerprint, response)
+            del self._done[key]
+        entry = self._in_flight.get(key)
+        if entry is not None:
+            fingerprint, future, started = entry
+            if time.monotonic() - started < IDEMPOTENCY_IN_FLIGHT_SECONDS:
+                self.coalesced += 1
+                return "in_flight", (fingerprint, future, started)
+            self.fail(key, future, RuntimeError("Request did not complete"))
+        return None, None
+
+    def begin(self, key: str, fingerprint: str) -> asyncio.Future:
+        """Register this caller as the one producing `key`; pass the future to finish() or fail()."""
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = (fingerprint, future, time.monotonic())
+        return future
+
+    def _release(self, key: str, future: asyncio.Future):
+        entry = self._in_flight.get(key)
+        if entry is not None and entry[1] is future:
+            del self._in_flight[key]
+            return entry[0]
+        return None
+
+    def finish(self, key: str, future: asyncio.Future, response: dict, ttl: float):
+        fingerprint = self._release(key, future)
+        if fingerprint is not None and ttl > 0:
+            self._done[key] = (time.monotonic() + ttl, fingerprint, response)
+            while len(self._done) > self.max_items:
+                self._done.popitem(last=False)
+        if not future.done():
+            future.set_result(response)
+
+    def fail(self, key: str, future: asyncio.Future, error: Exception):
+        self._release(key, future)
+        if not future.done():
+            future.set_exception(error)
+            # Marked as retrieved, so an error nobody waited for isn't logged as unhandled.
+            future.exception()
+
+    async def wait(self, state: str, entry: tuple, fingerprint: str) -> dict:
+        """
+        The response of a request found by lookup(). Waiting on one in flight
+        gives up once it has run IDEMPOTENCY_IN_FLIGHT_SECONDS, in case its
+        producer is gone without calling finish() or fail(). Raises
+        OriginalRequestFailed when that request failed or was abandoned.
+        """
+        stored_fingerprint, value = entry[:2]
+        if stored_fingerprint != fingerprint:
+            raise IdempotencyKeyReused()
+        if state == "done":
+            return value
+        remaining = IDEMPOTENCY_IN_FLIGHT_SECONDS - (time.monotonic() - entry[2])
+        try:
+            return await asyncio.wait_for(asyncio.shield(value), max(remaining, 0.0))
+        except asyncio.TimeoutError:
+            raise OriginalRequestFailed("Request did not complete")
+        except Exception as e:
+            raise OriginalRequestFailed(str(e)) from e
+
+    async def run(self, key: str, fingerprint: str, produce, ttl: float):
+        """
+        The response for `key`, produced by `produce()` at most once.
+        Returns (response, shared) where shared tells it was not produced for
+        this caller. Raises IdempotencyKeyReused if `key` belongs to a different
+        request, and OriginalRequestFailed if the run it waited on failed.
+        """
+        state, entry = self.lookup(key)
+        if state is not None:
+            return await self.wait(state, entry, fingerprint), True
+        future = self.begin(key, fingerprint)
+        try:
+            response = await produce()
+        except BaseException as e:
+            self.fail(key, future, e if isinstance(e, Exception) else RuntimeError("Request was cancelled"))
+            raise
+        self.finish(key, future, response, ttl)
+        return response, False
+
+
+user_limiter = TokenBucketLimiter(RATE_LIMIT_USER_PER_MINUTE, RATE_LIMIT_USER_BURST)
+ip_limiter = TokenBucketLimiter(RATE_LIMIT_IP_PER_MINUTE, RATE_LIMIT_IP_BURST)
+send_coalescer = RequestCoalescer()
+
+
+def client_ip(request) -> str:
+    """Address of the client, read through RATE_LIMIT_TRUSTED_PROXIES proxy hops."""
+    if RATE_LIMIT_TRUSTED_PROXIES > 0:
+        hops = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+        if len(hops) >= RATE_LIMIT_TRUSTED_PROXIES:
+            return hops[-RATE_LIMIT_TRUSTED_PROXIES]
+    return request.client.host if request.client else "unknown"
+
+
+def retry_after(request, user_id=None) -> float:
+    """0.0 if the request may proceed, otherwise the seconds until its client may retry."""
+    wait = ip_limiter.acquire(client_ip(request))
+    if wait == 0.0 and user_id:
+        wait = user_limiter.acquire(str(user_id))
+    return wait
+
+
+def request_key(request, data: dict) -> tuple:
+    """
+    (coalescing key, fingerprint of the request, ttl of its response). The
+    client's Idempotency-Key header wins; otherwise the request itself is the
+    key, so identical messages from one user within DUPLICATE_WINDOW_SECONDS
+    (a double click, a client retry) run once.
+    """
+    fingerprint = hashlib.sha256(json.dumps(
+        [data.get("user_id"), data.get("property_id"), data.get("role"), str(data.get("message", "")).strip()]
+    ).encode("utf-8")).hexdigest()
+    explicit = request.headers.get("idempotency-key")
+    if explicit:
+        return f"key:{data.get('user_id')}:{explicit}", fingerprint, IDEMPOTENCY_TTL_SECONDS
+    return f"request:{fingerprint}", fingerprint, DUPLICATE_WINDOW_SECONDS
+
+
+def stats() -> dict:
+    return {
+        "limited": {"user": user_limiter.limited, "ip": ip_limiter.limited},
+        "coalesced": send_coalescer.coalesced,
+        "replayed": send_coalescer.replayed,
+    }
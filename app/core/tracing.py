@@ -0,0 +1,159 @@
+# app/core/tracing.py
+import asyncio
+import functools
+import inspect
+import logging
+import threading
+import time
+
+from app.logger import logger
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram with one series per label set."""
+
+    def __init__(self, name: str, help_text: str, label_names: tuple, buckets: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                labels = dict(zip(self.label_names, key))
+                for bound, count in zip(self.buckets, series["counts"]):
+                    lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': bound})} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {series['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {series['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {series['count']}")
+        return lines
+
+    def snapshot(self) -> dict:
+        """Raw per-series data, keyed by label tuple."""
+        with self._lock:
+            return {key: dict(series, counts=list(series["counts"])) for key, series in self._series.items()}
+
+
+stage_latency = Histogram(
+    "rentizy_stage_latency_seconds",
+    "Wall time of each pipeline stage (LLM calls, Chroma operations, requests).",
+    ("stage", "status"),
+    LATENCY_BUCKETS,
+)
+llm_tokens = Histogram(
+    "rentizy_llm_tokens",
+    "Prompt and completion tokens per LLM call.",
+    ("stage", "model", "kind"),
+    TOKEN_BUCKETS,
+)
+
+# Metrics computed at scrape time from the caches' own counters.
+_collectors = []
+
+
+def register_collector(name: str, help_text: str, collect, metric_type: str = "gauge"):
+    """`collect()` returns a list of (labels dict, value) pairs for the metric `name`."""
+    _collectors.append((name, help_text, collect, metric_type))
+
+
+def render_prometheus() -> str:
+    lines = stage_latency.render() + llm_tokens.render()
+    for name, help_text, collect, metric_type in _collectors:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+        try:
+            for labels, value in collect():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        except Exception as e:
+            logger.error(f"Metrics collector {name} failed: {e}")
+    return "\n".join(lines) + "\n"
+
+
+def _record(stage: str, started: float, status: str):
+    elapsed = time.perf_counter() - started
+    stage_latency.observe(elapsed, stage=stage, status=status)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"[TRACE] {stage} {status} in {elapsed * 1000:.1f} ms")
+
+
+def traced(stage: str):
+    """Decorator recording the wall time of a sync or async function (or async generator) under `stage`."""
+    def decorator(fn):
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def async_gen_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    async for item in fn(*args, **kwargs):
+                        yield item
+                except Exception:
+                    _record(stage, started, "error")
+                    raise
+                _record(stage, started, "ok")
+            return async_gen_wrapper
+
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    result = await fn(*args, **kwargs)
+                except Exception:
+                    _record(stage, started, "error")
+                    raise
+                _record(stage, started, "ok")
+                return result
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                _record(stage, started, "error")
+                raise
+            _record(stage, started, "ok")
+            return result
+        return wrapper
+    return decorator
+
+
+def traced_call(stage: str, fn, *args, **kwargs):
+    """Call `fn` and record its wall time, e.g. `asyncio.to_thread(traced_call, "chroma.query", collection.query, ...)`."""
+    return traced(stage)(fn)(*args, **kwargs)
+
+
+def record_usage(stage: str, response):
+    """Record token usage from an OpenAI chat completion response."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    model = getattr(response, "model", "") or ""
+    llm_tokens.observe(usage.prompt_tokens or 0, stage=stage, model=model, kind="prompt")
+    llm_tokens.observe(usage.completion_tokens or 0, stage=stage, model=model, kind="completion")
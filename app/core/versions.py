@@ -0,0 +1,75 @@
+# app/core/versions.py
+import os
+import sqlite3
+import threading
+import time
+
+KNOWLEDGE_VERSIONS_PATH = os.environ.get("KNOWLEDGE_VERSIONS_PATH", "data/knowledge_versions.db")
+
+
+class KnowledgeVersions:
+    """
+    Monotonic version counter per knowledge key (e.g. an attribute).
+
+    Kept in SQLite rather than in memory so every worker process sees a bump
+    made by any other, which is what lets caches keyed on these versions
+    invalidate exactly when the stored facts change. compare_and_swap() makes
+    the same counters usable as write tickets across workers.
+    """
+
+    def __init__(self, path: str = KNOWLEDGE_VERSIONS_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS versions (key TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(versions)")]
+        if "updated_at" not in columns:
+            self._db.execute("ALTER TABLE versions ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+        self._db.commit()
+
+    def get(self, key: str) -> int:
+        with self._lock:
+            row = self._db.execute("SELECT version FROM versions WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def get_with_timestamp(self, key: str) -> tuple:
+        """(version, time of the last change); (0, 0.0) for an unknown key."""
+        with self._lock:
+            row = self._db.execute("SELECT version, updated_at FROM versions WHERE key = ?", (key,)).fetchone()
+        return (row[0], row[1]) if row else (0, 0.0)
+
+    def bump(self, key: str) -> int:
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO versions (key, version, updated_at) VALUES (?, 1, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at",
+                    (key, time.time()),
+                )
+                (version,) = self._db.execute("SELECT version FROM versions WHERE key = ?", (key,)).fetchone()
+        return version
+
+    def compare_and_swap(self, key: str, expected: int):
+        """
+        Advance `key` from `expected` to `expected + 1` in one statement.
+        Returns the new version, or None if another writer moved it first.
+        """
+        with self._lock:
+            with self._db:
+                if expected == 0:
+                    cursor = self._db.execute(
+                        "INSERT INTO versions (key, version, updated_at) VALUES (?, 1, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET version = 1, updated_at = excluded.updated_at "
+                        "WHERE version = 0",
+                        (key, time.time()),
+                    )
+                else:
+                    cursor = self._db.execute(
+                        "UPDATE versions SET version = version + 1, updated_at = ? WHERE key = ? AND version = ?",
+                        (time.time(), key, expected),
+                    )
+        return expected + 1 if cursor.rowcount == 1 else None
+
+
+knowledge_versions = KnowledgeVersions()
@@ -0,0 +1,205 @@
+# app/helpers/classifier.py
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from app.logger import logger
+
+ALLOWED_ATTRIBUTES = ["rooms", "amenities", "appliances", "location", "price", "neighbors"]
+DEFAULT_ATTRIBUTE = "general"
+
+# Minimum cosine similarity to the best centroid, and minimum gap to the runner-up,
+# before the centroid tier answers on its own instead of deferring to the LLM.
+CENTROID_MIN_SIMILARITY = float(os.environ.get("ATTRIBUTE_CENTROID_MIN_SIMILARITY", "0.35"))
+CENTROID_MIN_MARGIN = float(os.environ.get("ATTRIBUTE_CENTROID_MIN_MARGIN", "0.05"))
+MEMO_MAX_ITEMS = int(os.environ.get("ATTRIBUTE_MEMO_MAX_ITEMS", "5000"))
+
+# Keywords and phrases that unambiguously point at one attribute.
+LEXICON = {
+    "rooms": [
+        "room", "rooms", "bedroom", "bedrooms", "bathroom", "bathrooms", "bath", "baths",
+        "studio", "studios", "kitchen", "kitchens", "living room", "square feet", "sq ft", "sqm", "closet",
+        "closets", "floor plan",
+    ],
+    "amenities": [
+        "parking", "garage", "garages", "pool", "pools", "gym", "wifi", "wi-fi", "internet", "laundry",
+        "elevator", "elevators", "garden", "gardens", "balcony", "balconies", "terrace", "air conditioning",
+        "heating", "storage", "furnished", "pet", "pets",
+    ],
+    "appliances": [
+        "appliance", "appliances", "washer", "dryer", "dishwasher", "fridge", "fridges", "refrigerator",
+        "oven", "ovens", "stove", "microwave", "washing machine", "freezer", "cooktop",
+    ],
+    "location": [
+        "location", "located", "address", "downtown", "nearby", "close to", "far from", "distance",
+        "bus", "metro", "subway", "train station", "neighborhood", "neighbourhood", "walking distance",
+    ],
+    "price": [
+        "rent", "rents", "rented", "renting", "price", "prices", "priced", "cost", "costs", "costing",
+        "deposit", "deposits", "fee", "fees", "per month", "monthly", "utilities included", "how much",
+        "$", "€", "dollar", "dollars", "euro", "euros", "expensive", "cheap", "cheaper", "afford", "affordable",
+    ],
+    "neighbors": [
+        "neighbor", "neighbors", "neighbour", "neighbours", "noisy", "noise", "quiet", "next door",
+    ],
+}
+
+# Labelled examples whose embeddings form the centroid of each attribute.
+EXAMPLES = {
+    "rooms": [
+        "How many bedrooms does the apartment have?",
+        "The flat has two bedrooms and one bathroom.",
+        "Is the kitchen separate from the living room?",
+    ],
+    "amenities": [
+        "Is there parking available?",
+        "The building has a gym and a shared pool.",
+        "Does the place come with internet?",
+    ],
+    "appliances": [
+        "Is there a washing machine?",
+        "The kitchen includes a dishwasher and a new oven.",
+        "Does it have a fridge and microwave?",
+    ],
+    "location": [
+        "Where is the apartment located?",
+        "It's a five minute walk from the metro station.",
+        "Is it close to the university?",
+    ],
+    "price": [
+        "How much is the rent?",
+        "The monthly rent is 900 dollars plus utilities.",
+        "Is a security deposit required?",
+    ],
+    "neighbors": [
+        "Are the neighbors noisy?",
+        "The neighbors upstairs are a quiet retired couple.",
+        "Who lives next door?",
+    ],
+}
+
+
+def _term_pattern(term: str) -> str:
+    # Word boundaries only on a side that is a word character, so "$" and "€"
+    # still match right before a number ("$1400").
+    pattern = re.escape(term)
+    if re.match(r"\w", term):
+        pattern = rf"(?<!\w){pattern}"
+    if re.search(r"\w$", term):
+        pattern = rf"{pattern}(?!\w)"
+    return pattern
+
+
+def _compile_lexicon(lexicon):
+    patterns = {}
+    for label, terms in lexicon.items():
+        alternatives = "|".join(_term_pattern(term) for term in sorted(terms, key=len, reverse=True))
+        patterns[label] = re.compile(alternatives, re.IGNORECASE)
+    return patterns
+
+
+class AttributeClassifier:
+    """
+    Local tiers run before the LLM attribute classifier.
+
+    1. memo: exact (normalized) text seen before.
+    2. lexicon: keyword matching; answers when exactly one attribute matches.
+    3. centroid: cosine similarity between the text embedding and the mean
+       embedding of labelled examples; answers above a confidence threshold.
+
+    Anything still undecided returns None and the caller falls back to the LLM,
+    recording its answer with `remember` so the next identical text is a memo hit.
+    """
+
+    def __init__(self, embed=None):
+        self.embed = embed
+        self._patterns = _compile_lexicon(LEXICON)
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._labels = None
+        self._centroids = None
+        self.counts = {"memo": 0, "lexicon": 0, "centroid": 0, "llm": 0}
+
+    @staticmethod
+    def _normalize(text: str) -> str:
+        return " ".join(text.lower().split())
+
+    def remember(self, text: str, label: str, source: str = "llm"):
+        with self._lock:
+            key = self._normalize(text)
+            self._memo[key] = label
+            self._memo.move_to_end(key)
+            while len(self._memo) > MEMO_MAX_ITEMS:
+                self._memo.popitem(last=False)
+            if source in self.counts:
+                self.counts[source] += 1
+
+    def classify_fast(self, text: str):
+        """Memo and lexicon tiers only; pure CPU, safe to call on the event loop."""
+        key = self._normalize(text)
+        with self._lock:
+            label = self._memo.get(key)
+            if label is not None:
+                self._memo.move_to_end(key)
+                self.counts["memo"] += 1
+                return label
+        matched = [label for label, pattern in self._patterns.items() if pattern.search(text)]
+        if len(matched) == 1:
+            self.remember(text, matched[0], source="lexicon")
+            return matched[0]
+        return None
+
+    def _ensure_centroids(self):
+        if self._centroids is None:
+            labels = list(EXAMPLES)
+            centroids = []
+            for label in labels:
+                vectors = np.asarray(self.embed(EXAMPLES[label]), dtype=np.float32)
+                centroid = vectors.mean(axis=0)
+                centroids.append(centroid / np.linalg.norm(centroid))
+            self._labels = labels
+            self._centroids = np.vstack(centroids)
+        return self._labels, self._centroids
+
+    def classify_by_centroid(self, text: str):
+        """Nearest-centroid tier. Needs an embedding, so it may block on the embedding cache."""
+        return self.classify_many_by_centroid([text])[0]
+
+    def classify_many_by_centroid(self, texts: list) -> list:
+        """Centroid tier for a batch of texts, embedded in one call; None where undecided."""
+        if self.embed is None or not texts:
+            return [None] * len(texts)
+        try:
+            labels, centroids = self._ensure_centroids()
+            vectors = np.asarray(self.embed(list(texts)), dtype=np.float32)
+        except Exception as e:
+            logger.error(f"Centroid attribute classification failed: {e}")
+            return [None] * len(texts)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        similarities = vectors @ centroids.T
+        results = []
+        for text, row in zip(texts, similarities):
+            order = np.argsort(row)[::-1]
+            best, runner_up = row[order[0]], row[order[1]]
+            if best < CENTROID_MIN_SIMILARITY or best - runner_up < CENTROID_MIN_MARGIN:
+                results.append(None)
+                continue
+            label = labels[order[0]]
+            self.remember(text, label, source="centroid")
+            results.append(label)
+        return results
+
+    def warm_up(self):
+        """Embed the labelled examples ahead of the first request."""
+        if self.embed is not None:
+            self._ensure_centroids()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self.counts)
+        total = sum(counts.values())
+        counts["llm_skip_rate"] = (total - counts["llm"]) / total if total else 0.0
+        return counts
@@ -1,20 +1,46 @@
 # helpers.py
-import openai
+import asyncio
+import logging
+import os
+import random
 from app.logger import logger
 import json
-from openai import OpenAI
+from app.core.openai_client import async_client
+from app.core.db import embed_texts
+from app.helpers.classifier import AttributeClassifier, ALLOWED_ATTRIBUTES, DEFAULT_ATTRIBUTE
+from app.core.tracing import traced, record_usage
 
-# Use the existing client from your LLM module or initialize it here
-client = OpenAI()
+# Fraction of LLM payloads written to the DEBUG log; formatting them is skipped otherwise.
+LLM_PAYLOAD_LOG_SAMPLE_RATE = float(os.environ.get("LLM_PAYLOAD_LOG_SAMPLE_RATE", "0.1"))
+# Texts classified per LLM call by infer_attributes().
+ATTRIBUTE_LLM_BATCH_SIZE = int(os.environ.get("ATTRIBUTE_LLM_BATCH_SIZE", "50"))
+
+# Same shared client as app/core/llm.py
+client = async_client
+
+# Local tiers (memo, lexicon, embedding centroids) tried before the LLM classifier.
+attribute_classifier = AttributeClassifier(embed=embed_texts)
 
 def log_llm_input(label: str, payload: dict):
+    if not logger.isEnabledFor(logging.DEBUG) or random.random() >= LLM_PAYLOAD_LOG_SAMPLE_RATE:
+        return
     try:
         formatted = json.dumps(payload, indent=2, ensure_ascii=False)
     except Exception:
         formatted = str(payload)
-    logger.info(f"[LLM INPUT] {label} Payload:\n{formatted}")
+    logger.debug(f"[LLM INPUT] {label} Payload:\n{formatted}")
 
-def infer_attribute_from_text(text: str) -> str:
+async def infer_attribute_from_text(text: str) -> str:
+    attribute = attribute_classifier.classify_fast(text)
+    if attribute is None:
+        attribute = await asyncio.to_thread(attribute_classifier.classify_by_centroid, text)
+    if attribute is not None:
+        logger.info(f"Attribute resolved locally: '{attribute}'")
+        return attribute
+    return await _infer_attribute_with_llm(text)
+
+@traced("llm.infer_attribute")
+async def _infer_attribute_with_llm(text: str) -> str:
     system_prompt = """
 You are an assistant that categorizes property-related text.
 Analyze the given sentence and extract the primary feature axis it mentions.
@@ -27,7 +53,7 @@ Respond with exactly one word.
     try:
         log_llm_input("Attribute Inference", {"system": system_prompt, "user": user_prompt})
         
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="gpt-4o-mini",  # Using the desired model
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -36,72 +62,96 @@ Respond with exactly one word.
             temperature=0.0
         )
         
+        record_usage("llm.infer_attribute", response)
         raw_attribute = response.choices[0].message.content.strip().lower()
         logger.info(f"Raw attribute response: '{raw_attribute}'")
         
-        allowed = ["rooms", "amenities", "appliances", "location", "price","neighbors"]
         # Return one of the allowed values if it is present; otherwise, default to 'general'
-        if raw_attribute in allowed:
+        if raw_attribute in ALLOWED_ATTRIBUTES:
             attribute = raw_attribute
         else:
-            attribute = "general"
+            attribute = DEFAULT_ATTRIBUTE
+        attribute_classifier.remember(text, attribute)
             
     except Exception as e:
         logger.error(f"LLM call for attribute inference failed: {e}")
-        attribute = "general"
+        attribute = DEFAULT_ATTRIBUTE
     
     return attribute
 
-def determine_attribute_from_query(query: str) -> str:
-    """
-    Infer the attribute from a tenant query using the LLM.
-    """
-    attribute = infer_attribute_from_text(query)
-    logger.info(f"Inferred attribute from query '{query}': {attribute}")
-    return attribute
-
-def determine_attribute(content: str) -> str:
+async def infer_attributes(texts: list) -> list:
     """
-    Infer the attribute from an owner's content update using the LLM.
+    Batch form of infer_attribute_from_text: local tiers per text, the centroid
+    tier with one embedding call, then the rest in LLM calls of
+    ATTRIBUTE_LLM_BATCH_SIZE texts each.
     """
-    attribute = infer_attribute_from_text(content)
-    logger.info(f"Inferred attribute from content: {attribute}")
-    return attribute
+    labels = [attribute_classifier.classify_fast(text) for text in texts]
+    pending = [i for i, label in enumerate(labels) if label is None]
+    if pending:
+        by_centroid = await asyncio.to_thread(attribute_classifier.classify_many_by_centroid, [texts[i] for i in pending])
+        for i, label in zip(pending, by_centroid):
+            labels[i] = label
+        pending = [i for i in pending if labels[i] is None]
+    for start in range(0, len(pending), ATTRIBUTE_LLM_BATCH_SIZE):
+        chunk = pending[start:start + ATTRIBUTE_LLM_BATCH_SIZE]
+        for i, label in zip(chunk, await _infer_attributes_with_llm([texts[i] for i in chunk])):
+            labels[i] = label
+    logger.info(f"Classified {len(texts)} texts, {len(texts) - len(pending)} locally")
+    return labels
 
-
-def call_openai_merge_info(existing_doc: str, new_update: str) -> str:
-    """
-    Use an LLM to merge the existing document with the new update.
-    The merged version should preserve details from the existing document 
-    while incorporating new information or changes from the new_update.
-    """
+@traced("llm.infer_attribute_batch")
+async def _infer_attributes_with_llm(texts: list) -> list:
     system_prompt = """
-You are an assistant that consolidates property update information.
-Given an existing summary and a new update, produce a single, coherent summary 
-that includes all relevant details. If the new update contradicts or adds details, 
-incorporate these changes into the summary.
-Respond with the merged summary.
+You are an assistant that categorizes property-related text.
+For each numbered sentence, extract the primary feature axis it mentions.
+The allowed outputs are: rooms, amenities, appliances, location, price, neighbors, general.
+Use 'general' only if none of the other specific features are mentioned.
+Respond in JSON like this, with one label per sentence, in order:
+{"labels": ["price", "rooms"]}
 """
-    user_prompt = (
-        f"Existing document: \"{existing_doc}\"\n"
-        f"New update: \"{new_update}\"\n"
-        "Provide a merged summary that retains previous details and includes the new update."
-    )
-    
+    user_prompt = "\n".join(f"{i + 1}. {text}" for i, text in enumerate(texts))
     try:
-        logger.info("Calling LLM to merge info")
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",  # Using the desired model
+        log_llm_input("Attribute Inference (batch)", {"system": system_prompt, "user": user_prompt})
+        response = await client.chat.completions.create(
+            model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
             ],
+            response_format={"type": "json_object"},
             temperature=0.0
         )
-        merged = response.choices[0].message.content.strip()
-        logger.info(f"Merged result: {merged}")
-        return merged
+        record_usage("llm.infer_attribute_batch", response)
+        raw_labels = json.loads(response.choices[0].message.content).get("labels", [])
     except Exception as e:
-        logger.error(f"Merge LLM call failed: {e}")
-        # Fallback: If LLM call fails, just concatenate the documents.
-        return existing_doc + "\n" + new_update
+        logger.error(f"Batch LLM call for attribute inference failed: {e}")
+        return [DEFAULT_ATTRIBUTE] * len(texts)
+
+    if len(raw_labels) != len(texts):
+        logger.warning(f"Batch attribute inference returned {len(raw_labels)} labels for {len(texts)} texts")
+    labels = []
+    for i, text in enumerate(texts):
+        raw = str(raw_labels[i]).strip().lower() if i < len(raw_labels) else ""
+        label = raw if raw in ALLOWED_ATTRIBUTES else DEFAULT_ATTRIBUTE
+        if raw:
+            attribute_classifier.remember(text, label)
+        labels.append(label)
+    return labels
+
+@traced("attribute.query")
+async def determine_attribute_from_query(query: str) -> str:
+    """
+    Infer the attribute from a tenant query using the LLM.
+    """
+    attribute = await infer_attribute_from_text(query)
+    logger.info(f"Inferred attribute from query '{query}': {attribute}")
+    return attribute
+
+@traced("attribute.owner")
+async def determine_attribute(content: str) -> str:
+    """
+    Infer the attribute from an owner's content update using the LLM.
+    """
+    attribute = await infer_attribute_from_text(content)
+    logger.info(f"Inferred attribute from content: {attribute}")
+    return attribute
@@ -1,9 +1,20 @@
 import logging
+from contextvars import ContextVar
+
+# Request-scoped trace id, set by the HTTP middleware and stamped on every log line.
+trace_id_var = ContextVar("trace_id", default="-")
+
+class TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = trace_id_var.get()
+        return True
 
 logging.basicConfig(
     level=logging.INFO,  # Ensure this is INFO or lower
-    format="%(asctime)s [%(levelname)s] %(message)s"
+    format="%(asctime)s [%(levelname)s] [%(trace_id)s] %(message)s"
 )
+for handler in logging.getLogger().handlers:
+    handler.addFilter(TraceIdFilter())
 
 logger = logging.getLogger("chat-assistant")
 logger.setLevel(logging.INFO)
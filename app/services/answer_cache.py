@@ -0,0 +1,98 @@
+# app/services/answer_cache.py
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+ANSWER_CACHE_MAX_ITEMS = int(os.environ.get("ANSWER_CACHE_MAX_ITEMS", "1000"))
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "3600"))
+# Cosine similarity a new question needs with a cached one to reuse its answer.
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0.95"))
+
+
+class AnswerCache:
+    """
+    Semantic cache for tenant answers.
+
+    Entries are grouped by attribute and stamped with the knowledge version of
+    that attribute at the time they were generated. A lookup only considers
+    entries with the current version, so a save/update of the attribute
+    invalidates every answer built on the old facts. Entries also expire after
+    a TTL, and the least recently used entry is evicted past `max_items`.
+    """
+
+    def __init__(self, max_items: int = ANSWER_CACHE_MAX_ITEMS,
+                 ttl: float = ANSWER_CACHE_TTL_SECONDS,
+                 similarity: float = ANSWER_CACHE_SIMILARITY):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.similarity = similarity
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _drop(self, entry_id):
+        del self._entries[entry_id]
+        self.evictions += 1
+
+    def get(self, attribute: str, version: int, vector):
+        """Return the cached payload for a similar question, or None."""
+        now = time.monotonic()
+        with self._lock:
+            candidates = []
+            for entry_id, entry in list(self._entries.items()):
+                if entry["attribute"] != attribute:
+                    continue
+                if entry["expires"] < now or entry["version"] != version:
+                    self._drop(entry_id)
+                    continue
+                candidates.append((entry_id, entry))
+            if candidates:
+                matrix = np.vstack([entry["vector"] for _, entry in candidates])
+                similarities = matrix @ self._unit(vector)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity:
+                    entry_id, entry = candidates[best]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return dict(entry["payload"])
+            self.misses += 1
+            return None
+
+    def put(self, attribute: str, version: int, vector, payload: dict):
+        with self._lock:
+            self._entries[self._next_id] = {
+                "attribute": attribute,
+                "version": version,
+                "vector": self._unit(vector),
+                "payload": dict(payload),
+                "expires": time.monotonic() + self.ttl,
+            }
+            self._next_id += 1
+            while len(self._entries) > self.max_items:
+                self._drop(next(iter(self._entries)))
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "items": len(self._entries),
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+answer_cache = AnswerCache()
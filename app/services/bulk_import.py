@@ -0,0 +1,291 @@
+# app/services/bulk_import.py
+import asyncio
+import csv
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from app.logger import logger
+from app.core.db import (
+    get_property_collection, embed_texts, is_valid_property_id, scoped_key, DEFAULT_PROPERTY_ID
+)
+from app.core.tracing import traced_call
+from app.core.versions import knowledge_versions
+from app.helpers.helpers import infer_attributes
+from app.services.knowledge import (
+    apply_owner_update, doc_version_key, get_fact_collection, label_topic_groups, plan_fact_writes,
+    split_facts, LIVE
+)
+
+IMPORTS_DB_PATH = os.environ.get("IMPORTS_DB_PATH", "data/imports.db")
+IMPORT_MAX_FACTS = int(os.environ.get("IMPORT_MAX_FACTS", "50000"))
+# Facts classified between two progress updates.
+IMPORT_CLASSIFY_CHUNK = int(os.environ.get("IMPORT_CLASSIFY_CHUNK", "500"))
+# Facts embedded per remote embedding request.
+IMPORT_EMBED_BATCH = int(os.environ.get("IMPORT_EMBED_BATCH", "256"))
+# Imported facts for attributes that already hold facts are written this many attributes at a time.
+IMPORT_MERGE_CONCURRENCY = int(os.environ.get("IMPORT_MERGE_CONCURRENCY", "4"))
+
+PROPERTY_FIELD = "property_id"
+
+
+def _sentence_facts(property_id: str, text: str) -> list:
+    return [(property_id, fact) for fact in split_facts(text)]
+
+
+def _field_fact(property_id: str, field: str, value) -> tuple:
+    if isinstance(value, (list, tuple)):
+        value = ", ".join(str(v) for v in value)
+    return property_id, f"{field.replace('_', ' ').strip()}: {str(value).strip()}"
+
+
+def _record_facts(record, property_id: str) -> list:
+    """Facts from one JSON value: a string, {"facts": [...]} or a flat field -> value object."""
+    if isinstance(record, str):
+        return _sentence_facts(property_id, record)
+    if not isinstance(record, dict):
+        raise ValueError("JSON entries must be strings or objects")
+    property_id = str(record.get(PROPERTY_FIELD) or property_id)
+    if "facts" in record:
+        facts = record["facts"]
+        if not isinstance(facts, (str, list)):
+            raise ValueError('"facts" must be a string or a list')
+        facts = [facts] if isinstance(facts, str) else facts
+        return [fact for text in facts for fact in _sentence_facts(property_id, str(text))]
+    return [
+        _field_fact(property_id, field, value)
+        for field, value in record.items()
+        if field != PROPERTY_FIELD and value not in (None, "", [])
+    ]
+
+
+def parse_listing_sheet(content: str, fmt: str, property_id: str = DEFAULT_PROPERTY_ID) -> list:
+    """
+    Split a listing sheet into (property_id, fact) pairs.
+
+      text  one fact per sentence
+      json  a string, an object or a list of them; objects are either
+            {"property_id", "facts": [...]} or flat fields ({"rent": "$1400"})
+      csv   with a "fact" column, one fact per row; otherwise one listing per
+            row and one "column: value" fact per non-empty cell
+    An optional property_id field/column overrides `property_id` per entry.
+    Raises ValueError for malformed input.
+    """
+    fmt = fmt.lower()
+    if fmt == "text":
+        facts = _sentence_facts(property_id, content)
+    elif fmt == "json":
+        try:
+            data = json.loads(content)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON: {e}")
+        records = data if isinstance(data, list) else [data]
+        facts = [pair for record in records for pair in _record_facts(record, property_id)]
+    elif fmt == "csv":
+        reader = csv.DictReader(io.StringIO(content))
+        if not reader.fieldnames:
+            raise ValueError("CSV has no header row")
+        facts = []
+        for row in reader:
+            row_property = (row.get(PROPERTY_FIELD) or "").strip() or property_id
+            if "fact" in reader.fieldnames:
+                facts.extend(_sentence_facts(row_property, row.get("fact") or ""))
+            else:
+                facts.extend(
+                    _field_fact(row_property, field, value)
+                    for field, value in row.items()
+                    if field and field != PROPERTY_FIELD and value and value.strip()
+                )
+    else:
+        raise ValueError(f"Unsupported format '{fmt}'; use csv, json or text")
+
+    invalid = sorted({pid for pid, _ in facts if not is_valid_property_id(pid)})
+    if invalid:
+        raise ValueError(f"Invalid property ids: {', '.join(invalid[:5])}")
+    if len(facts) > IMPORT_MAX_FACTS:
+        raise ValueError(f"Too many facts ({len(facts)}); the limit is {IMPORT_MAX_FACTS}")
+    return facts
+
+
+class ImportStatusStore:
+    """Progress of bulk imports, in SQLite so any worker process can report it."""
+
+    FIELDS = ("status", "total_facts", "properties", "classified", "documents_total", "documents_written", "error")
+
+    def __init__(self, path: str = IMPORTS_DB_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS imports (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                total_facts INTEGER NOT NULL,
+                properties INTEGER NOT NULL,
+                classified INTEGER NOT NULL DEFAULT 0,
+                documents_total INTEGER NOT NULL DEFAULT 0,
+                documents_written INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._db.commit()
+
+    def create(self, total_facts: int, properties: int) -> str:
+        import_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO imports (id, status, total_facts, properties, created_at, updated_at) "
+                "VALUES (?, 'running', ?, ?, ?, ?)",
+                (import_id, total_facts, properties, now, now),
+            )
+        return import_id
+
+    def update(self, import_id: str, **fields):
+        columns = [name for name in fields if name in self.FIELDS]
+        assignments = ", ".join(f"{name} = ?" for name in columns)
+        with self._lock, self._db:
+            self._db.execute(
+                f"UPDATE imports SET {assignments}, updated_at = ? WHERE id = ?",
+                (*(fields[name] for name in columns), time.time(), import_id),
+            )
+
+    def get(self, import_id: str):
+        with self._lock:
+            row = self._db.execute("SELECT * FROM imports WHERE id = ?", (import_id,)).fetchone()
+        if row is None:
+            return None
+        status = dict(row)
+        status["import_id"] = status.pop("id")
+        return status
+
+
+import_status = ImportStatusStore()
+
+
+def attributes_with_facts(documents: list) -> dict:
+    """{(property_id, attribute): set of live topics} for the `documents` that already have live facts."""
+    by_property = OrderedDict()
+    for property_id, attribute in documents:
+        by_property.setdefault(property_id, []).append(attribute)
+    found = {}
+    for property_id, attributes in by_property.items():
+        collection = get_fact_collection(property_id, create=False)
+        if collection is None:
+            continue
+        result = traced_call(
+            "chroma.get", collection.get,
+            where={"$and": [{"attribute": {"$in": attributes}}, {"status": LIVE}]}, include=["metadatas"]
+        )
+        for meta in result["metadatas"]:
+            found.setdefault((property_id, meta["attribute"]), set()).add(meta.get("topic") or "")
+    return found
+
+
+def claim_new_documents(documents: list) -> dict:
+    """Take the first write ticket of each attribute without facts; returns {document: version}."""
+    claimed = {}
+    for property_id, attribute in documents:
+        version = knowledge_versions.compare_and_swap(doc_version_key(property_id, attribute), 0)
+        if version is not None:
+            claimed[(property_id, attribute)] = version
+    return claimed
+
+
+def write_new_facts(batch: list, vectors: list):
+    """Upsert a batch of (document, fact_id, text, metadata) with precomputed vectors, one call per property."""
+    by_property = OrderedDict()
+    for ((property_id, _), record_id, text, meta), vector in zip(batch, vectors):
+        rows = by_property.setdefault(property_id, {"ids": [], "documents": [], "metadatas": [], "embeddings": []})
+        rows["ids"].append(record_id)
+        rows["documents"].append(text)
+        rows["metadatas"].append(meta)
+        rows["embeddings"].append(vector)
+    for property_id, rows in by_property.items():
+        traced_call("chroma.upsert", get_property_collection(property_id).upsert, **rows)
+
+
+async def run_import(import_id: str, facts: list, user_id=None):
+    """
+    Classify, group and store the facts of an import:
+    attributes are inferred in batches, facts are grouped per (property,
+    attribute) and labelled with topics in the same vocabulary as the
+    attribute's live facts, the facts of attributes that hold none yet are embedded
+    IMPORT_EMBED_BATCH at a time and upserted as records, and facts for
+    attributes that already do go through the regular append + invalidate.
+    """
+    started = time.perf_counter()
+    try:
+        texts = [fact for _, fact in facts]
+        labels = []
+        for start in range(0, len(texts), IMPORT_CLASSIFY_CHUNK):
+            labels += await infer_attributes(texts[start:start + IMPORT_CLASSIFY_CHUNK])
+            await asyncio.to_thread(import_status.update, import_id, classified=len(labels))
+
+        groups = OrderedDict()
+        for (property_id, fact), attribute in zip(facts, labels):
+            groups.setdefault((property_id, attribute), []).append({"content": fact, "topic": ""})
+        await asyncio.to_thread(import_status.update, import_id, documents_total=len(groups))
+
+        existing = await asyncio.to_thread(attributes_with_facts, list(groups))
+        topics = await label_topic_groups([
+            ([fact["content"] for fact in group], existing.get(document, ())) for document, group in groups.items()
+        ])
+        for group, group_topics in zip(groups.values(), topics):
+            for fact, topic in zip(group, group_topics):
+                fact["topic"] = topic
+        claimed = await asyncio.to_thread(claim_new_documents, [doc for doc in groups if doc not in existing])
+        to_merge = [doc for doc in groups if doc not in claimed]
+        written = 0
+
+        fresh = []
+        for document, version in claimed.items():
+            property_id, attribute = document
+            records, _ = plan_fact_writes(attribute, groups[document], user_id=user_id, property_id=property_id)
+            for record_id, text, meta in records:
+                meta["version"] = version
+                fresh.append((document, record_id, text, meta))
+        for start in range(0, len(fresh), IMPORT_EMBED_BATCH):
+            batch = fresh[start:start + IMPORT_EMBED_BATCH]
+            vectors = await asyncio.to_thread(embed_texts, [text for _, _, text, _ in batch])
+            await asyncio.to_thread(write_new_facts, batch, vectors)
+            # An attribute counts as written once its last record is.
+            finished = {document for document, _, _, _ in batch}
+            if start + IMPORT_EMBED_BATCH < len(fresh):
+                finished.discard(fresh[start + IMPORT_EMBED_BATCH][0])
+            for property_id, attribute in finished:
+                await asyncio.to_thread(knowledge_versions.bump, scoped_key(property_id, attribute))
+            written += len(finished)
+            await asyncio.to_thread(import_status.update, import_id, documents_written=written)
+
+        limit = asyncio.Semaphore(IMPORT_MERGE_CONCURRENCY)
+
+        async def merge(document):
+            nonlocal written
+            property_id, attribute = document
+            async with limit:
+                await apply_owner_update(attribute, groups[document], user_id=user_id, property_id=property_id)
+            written += 1
+            await asyncio.to_thread(import_status.update, import_id, documents_written=written)
+
+        await asyncio.gather(*(merge(document) for document in to_merge))
+        await asyncio.to_thread(import_status.update, import_id, status="done")
+        logger.info(
+            f"Import {import_id}: {len(facts)} facts for {len(groups)} attributes "
+            f"({len(fresh)} records for {len(claimed)} new, {len(to_merge)} appended to existing) "
+            f"in {time.perf_counter() - started:.1f}s"
+        )
+    except Exception as e:
+        logger.error(f"Import {import_id} failed: {e}")
+        await asyncio.to_thread(import_status.update, import_id, status="failed", error=str(e))
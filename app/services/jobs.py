@@ -0,0 +1,361 @@
+# app/services/jobs.py
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+from app.logger import logger
+from app.core.db import DEFAULT_PROPERTY_ID
+from app.services.knowledge import extract_owner_fact, apply_owner_update
+
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", "data/jobs.db")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "5"))
+JOB_BACKOFF_BASE_SECONDS = float(os.environ.get("JOB_BACKOFF_BASE_SECONDS", "1.0"))
+JOB_BACKOFF_MAX_SECONDS = float(os.environ.get("JOB_BACKOFF_MAX_SECONDS", "60.0"))
+# A claimed job whose worker died is picked up again once its lease runs out.
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "300"))
+# How often idle workers look for retries that became due (or work enqueued by other processes).
+JOB_POLL_INTERVAL_SECONDS = float(os.environ.get("JOB_POLL_INTERVAL_SECONDS", "1.0"))
+# Finished jobs stay queryable by id this long, then are deleted; the sweep
+# runs at most once per interval in each process.
+JOB_RETENTION_SECONDS = float(os.environ.get("JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+JOB_PURGE_INTERVAL_SECONDS = float(os.environ.get("JOB_PURGE_INTERVAL_SECONDS", "3600"))
+
+# queued -> running -> ready -> merging -> done
+#                  \-> ignored                \-> failed (after JOB_MAX_ATTEMPTS)
+FINISHED_STATUSES = ("done", "ignored", "failed")
+
+
+def backoff_delay(attempts: int) -> float:
+    """Exponential backoff with jitter, so retries of a burst don't line up."""
+    delay = min(JOB_BACKOFF_MAX_SECONDS, JOB_BACKOFF_BASE_SECONDS * 2 ** max(attempts - 1, 0))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class JobQueue:
+    """
+    Durable queue of owner messages, in SQLite so accepted messages survive a
+    restart and every worker process shares the same jobs.
+
+    A job is first classified (running -> ready, with its attribute, the
+    fact to save and its topic), then written. Ready jobs for the same
+    property and attribute are claimed together, so a burst of facts costs
+    one write. Claims carry a
+    token and a lease: only the claimant can move a job on, and a job whose
+    claimant crashed becomes claimable again when the lease expires.
+    A finished job drops the history window from its payload right away and
+    is deleted after JOB_RETENTION_SECONDS.
+    """
+
+    def __init__(self, path: str = JOBS_DB_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                property_id TEXT NOT NULL DEFAULT 'default',
+                attribute TEXT,
+                content TEXT,
+                topic TEXT,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                available_at REAL NOT NULL,
+                claim TEXT,
+                lease_until REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at);
+            """
+        )
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(jobs)")]
+        if "property_id" not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN property_id TEXT NOT NULL DEFAULT 'default'")
+        if "topic" not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN topic TEXT")
+        self._db.execute("DROP INDEX IF EXISTS jobs_attribute")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_document ON jobs (property_id, attribute, status)")
+        self._db.commit()
+
+    @staticmethod
+    def _row(row) -> dict:
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def enqueue(self, payload: dict, property_id: str = DEFAULT_PROPERTY_ID) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO jobs (id, status, payload, property_id, available_at, created_at, updated_at) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, json.dumps(payload), property_id, now, now, now),
+            )
+        return job_id
+
+    def get(self, job_id: str):
+        with self._lock:
+            row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(row) if row else None
+
+    def claim_queued(self, lease: float = JOB_LEASE_SECONDS):
+        """Claim the oldest job waiting for classification, or None."""
+        claim = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._db:
+            # A single UPDATE, so two processes can never claim the same job.
+            self._db.execute(
+                "UPDATE jobs SET status = 'running', claim = ?, lease_until = ?, updated_at = ? "
+                "WHERE id = (SELECT id FROM jobs "
+                "            WHERE (status = 'queued' AND available_at <= ?) "
+                "               OR (status = 'running' AND lease_until < ?) "
+                "            ORDER BY created_at LIMIT 1)",
+                (claim, now + lease, now, now, now),
+            )
+            row = self._db.execute("SELECT * FROM jobs WHERE claim = ?", (claim,)).fetchone()
+        return self._row(row) if row else None
+
+    def mark_ready(self, job: dict, attribute: str, content: str, topic: str = ""):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE jobs SET status = 'ready', attribute = ?, content = ?, topic = ?, claim = NULL, "
+                "lease_until = NULL, available_at = ?, updated_at = ? WHERE id = ? AND claim = ?",
+                (attribute, content, topic, now, now, job["id"], job["claim"]),
+            )
+
+    def claim_ready(self, exclude=(), lease: float = JOB_LEASE_SECONDS):
+        """
+        Claim every classified job of one (property, attribute) document,
+        skipping the (property, attribute) pairs in `exclude`.
+        Returns ((property_id, attribute), jobs oldest first) or None.
+        """
+        claim = uuid.uuid4().hex
+        now = time.time()
+        exclude = list(exclude)
+        skip = "".join(" AND NOT (property_id = ? AND attribute = ?)" for _ in exclude)
+        claimable = "((status = 'ready' AND available_at <= ?) OR (status = 'merging' AND lease_until < ?))"
+        with self._lock, self._db:
+            row = self._db.execute(
+                f"SELECT property_id, attribute FROM jobs WHERE {claimable}{skip} ORDER BY created_at LIMIT 1",
+                (now, now, *(value for pair in exclude for value in pair)),
+            ).fetchone()
+            if row is None:
+                return None
+            document = (row["property_id"], row["attribute"])
+            self._db.execute(
+                f"UPDATE jobs SET status = 'merging', claim = ?, lease_until = ?, updated_at = ? "
+                f"WHERE property_id = ? AND attribute = ? AND {claimable}",
+                (claim, now + lease, now, *document, now, now),
+            )
+            rows = self._db.execute(
+                "SELECT * FROM jobs WHERE claim = ? ORDER BY created_at, rowid", (claim,)
+            ).fetchall()
+        if not rows:
+            return None
+        return document, [self._row(r) for r in rows]
+
+    def finish(self, jobs: list, status: str, result: dict = None):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "UPDATE jobs SET status = ?, result = ?, error = NULL, claim = NULL, lease_until = NULL, "
+                "payload = json_remove(payload, '$.history'), updated_at = ? WHERE id = ? AND claim = ?",
+                [(status, json.dumps(result), now, job["id"], job["claim"]) for job in jobs],
+            )
+
+    def retry(self, jobs: list, error: str, max_attempts: int = JOB_MAX_ATTEMPTS):
+        """Return claimed jobs to the phase they failed in, after a backoff, or fail them."""
+        now = time.time()
+        updates = []
+        for job in jobs:
+            attempts = job["attempts"] + 1
+            if attempts >= max_attempts:
+                status, available_at = "failed", now
+            else:
+                # Classification failures are retried from scratch, merge failures as ready.
+                status = "queued" if job["status"] == "running" else "ready"
+                available_at = now + backoff_delay(attempts)
+            updates.append((status, error, attempts, available_at, now, job["id"], job["claim"]))
+        with self._lock, self._db:
+            self._db.executemany(
+                "UPDATE jobs SET status = ?1, error = ?2, attempts = ?3, available_at = ?4, claim = NULL, "
+                "lease_until = NULL, updated_at = ?5, "
+                "payload = CASE WHEN ?1 = 'failed' THEN json_remove(payload, '$.history') ELSE payload END "
+                "WHERE id = ?6 AND claim = ?7",
+                updates,
+            )
+
+    def purge_finished(self, older_than: float = JOB_RETENTION_SECONDS) -> int:
+        """Delete jobs that finished more than `older_than` seconds ago; returns how many."""
+        placeholders = ", ".join("?" for _ in FINISHED_STATUSES)
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                f"DELETE FROM jobs WHERE status IN ({placeholders}) AND updated_at < ?",
+                (*FINISHED_STATUSES, time.time() - older_than),
+            )
+        return cursor.rowcount
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+
+class OwnerJobWorkers:
+    """In-process pool of asyncio workers draining the job queue."""
+
+    def __init__(self, queue: JobQueue, concurrency: int = JOB_WORKERS):
+        self.queue = queue
+        self.concurrency = concurrency
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+        # (property, attribute) documents being merged by this process; their
+        # new ready jobs wait for the next round so they are merged together.
+        self._merging = set()
+        self._purged_at = 0.0
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                worked = await self._step()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job worker error: {e}")
+                worked = False
+            if not worked:
+                await self._purge_if_due()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def _purge_if_due(self):
+        if time.time() - self._purged_at < JOB_PURGE_INTERVAL_SECONDS:
+            return
+        self._purged_at = time.time()
+        try:
+            purged = await asyncio.to_thread(self.queue.purge_finished)
+        except Exception as e:
+            logger.error(f"Purging finished jobs failed: {e}")
+            return
+        if purged:
+            logger.info(f"Purged {purged} finished job(s)")
+
+    async def _step(self) -> bool:
+        # Merges first: they finish jobs, and ready jobs pile up behind a
+        # running merge of the same attribute so they can share the next one.
+        batch = await asyncio.to_thread(self.queue.claim_ready, list(self._merging))
+        if batch is not None:
+            document, jobs = batch
+            self._merging.add(document)
+            try:
+                await self._merge(document, jobs)
+            finally:
+                self._merging.discard(document)
+            return True
+
+        job = await asyncio.to_thread(self.queue.claim_queued)
+        if job is not None:
+            await self._classify(job)
+            return True
+        return False
+
+    async def _classify(self, job: dict):
+        payload = job["payload"]
+        try:
+            fact = await extract_owner_fact(payload["message"], payload.get("history"))
+        except Exception as e:
+            logger.warning(f"Classifying owner job {job['id']} failed (attempt {job['attempts'] + 1}): {e}")
+            await asyncio.to_thread(self.queue.retry, [job], str(e))
+            return
+        if "attribute" not in fact:
+            await asyncio.to_thread(self.queue.finish, [job], "ignored", fact)
+            return
+        await asyncio.to_thread(self.queue.mark_ready, job, fact["attribute"], fact["content"], fact.get("topic", ""))
+        self.notify()
+
+    async def _merge(self, document: tuple, jobs: list):
+        property_id, attribute = document
+        latest = jobs[-1]["payload"]
+        try:
+            result = await apply_owner_update(
+                attribute,
+                [{"content": job["content"], "topic": job["topic"]} for job in jobs],
+                user_id=latest.get("user_id"),
+                conversation_id=latest.get("conversation_id"),
+                property_id=property_id
+            )
+        except Exception as e:
+            logger.warning(f"Merging {len(jobs)} job(s) for property '{property_id}' attribute '{attribute}' failed: {e}")
+            await asyncio.to_thread(self.queue.retry, jobs, str(e))
+            return
+        if len(jobs) > 1:
+            logger.info(f"Coalesced {len(jobs)} owner updates for property '{property_id}' attribute '{attribute}' into one write")
+        await asyncio.to_thread(self.queue.finish, jobs, "done", result)
+
+
+job_queue = JobQueue()
+owner_workers = OwnerJobWorkers(job_queue)
+
+
+async def submit_owner_message(message: str, history=None, user_id=None, conversation_id=None,
+                               property_id: str = DEFAULT_PROPERTY_ID) -> str:
+    """Persist an owner message for background processing and return its job id."""
+    job_id = await asyncio.to_thread(job_queue.enqueue, {
+        "message": message,
+        "history": history or [],
+        "user_id": user_id,
+        "conversation_id": conversation_id,
+    }, property_id)
+    owner_workers.notify()
+    return job_id
+
+
+def job_status(job_id: str):
+    """Public view of a job for the status endpoint, or None if unknown."""
+    job = job_queue.get(job_id)
+    if job is None:
+        return None
+    result = job["result"] or {}
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "property_id": job["property_id"],
+        "finished": job["status"] in FINISHED_STATUSES,
+        "saved": job["status"] == "done" and result.get("status") in ["saved", "updated"],
+        "attribute": job["attribute"],
+        "topic": job["topic"],
+        "result": job["result"],
+        "error": job["error"],
+        "attempts": job["attempts"],
+    }
@@ -1,94 +1,350 @@
 # app/services/knowledge.py
+import asyncio
 from datetime import datetime
 import logging
-from app.core.llm import call_openai_should_save
-from app.core.db import conversation_collection as chroma_collection  
-from app.helpers.helpers import determine_attribute, call_openai_merge_info
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from app.core.llm import call_openai_should_save, call_openai_label_topics
+from app.core.db import get_property_collection, embed_texts, scoped_key, DEFAULT_PROPERTY_ID
+from app.core.versions import knowledge_versions
+from app.core.tracing import traced_call
+from app.helpers.helpers import determine_attribute
 
 logger = logging.getLogger(__name__)
 
-def should_update(existing_doc, new_timestamp):
-    existing_ts = existing_doc.get("timestamp")
-    if not existing_ts:
-        return True
-    return new_timestamp > existing_ts
+# Attempts at a read -> compare-and-swap -> write cycle before giving up
+# (the job queue then retries the whole write later).
+MERGE_MAX_ATTEMPTS = int(os.environ.get("MERGE_MAX_ATTEMPTS", "5"))
+# A write ticket taken by a worker that never wrote its facts (it crashed
+# in between) is reclaimed after this long.
+MERGE_ABANDONED_SECONDS = float(os.environ.get("MERGE_ABANDONED_SECONDS", "120"))
+# Facts labelled per topic-labelling LLM call.
+TOPIC_LABEL_BATCH_SIZE = int(os.environ.get("TOPIC_LABEL_BATCH_SIZE", "50"))
 
-def process_owner_message(message, history="", user_id=None, conversation_id=None):
-    decision = call_openai_should_save(message, history)
-    if decision["action"] == "ignore":
-        logger.info("Owner update ignored: " + decision["reason"])
-        return {"status": "ignored", "reason": decision["reason"]}
-    
-    new_content = decision["content_to_save"]
-    new_ts = datetime.utcnow().isoformat()
-    
-    attribute = determine_attribute(new_content)
-    logger.info(f"Processing update for attribute '{attribute}' with content: '{new_content}' at {new_ts}")
-    
-    # Query candidate documents for this attribute.
-    results = chroma_collection.query(
-        query_texts=[attribute],
-        n_results=10,
+# Every owner fact is its own record. A newer fact on the same attribute and
+# topic supersedes the live one instead of being merged into it; retrieval
+# only ever sees live facts. Facts stored without a topic (migrated legacy
+# sentences) are labelled the first time a topical fact is written next to them.
+LIVE = "live"
+SUPERSEDED = "superseded"
+# Collection metadata marking a collection whose legacy per-attribute
+# documents have been split into fact records.
+FACT_SCHEMA_KEY = "fact_schema"
+FACT_SCHEMA_VERSION = 1
+
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9\"'])")
+
+class MergeConflictError(RuntimeError):
+    pass
+
+# One lock per (property, attribute): writes to different attributes run in
+# parallel, writes to the same one queue up inside this process.
+_write_locks = {}
+
+def write_lock(property_id: str, attribute: str) -> asyncio.Lock:
+    lock = _write_locks.get((property_id, attribute))
+    if lock is None:
+        lock = _write_locks[(property_id, attribute)] = asyncio.Lock()
+    return lock
+
+def doc_version_key(property_id: str, attribute: str) -> str:
+    """Versions-table key of the write tickets for the attribute's facts, "doc:{property}:{attribute}"."""
+    return f"doc:{property_id}:{attribute}"
+
+def split_facts(text: str) -> list:
+    """One fact per sentence; list bullets and blank lines are dropped."""
+    facts = []
+    for line in text.splitlines():
+        line = line.strip().lstrip("-*•").strip()
+        facts.extend(part.strip() for part in _SENTENCE_BREAK.split(line) if part.strip())
+    return facts
+
+def normalize_topic(topic) -> str:
+    """Snake-case sub-topic ("Pet policy" -> "pet_policy"); "" when there is none."""
+    return re.sub(r"[^a-z0-9]+", "_", str(topic or "").lower()).strip("_")[:64]
+
+def fact_id() -> str:
+    return f"fact-{uuid.uuid4().hex}"
+
+def fact_metadata(attribute, topic="", version=0, user_id=None, conversation_id=None,
+                  property_id=DEFAULT_PROPERTY_ID, supersedes=()) -> dict:
+    metadata = {
+        "property_id": property_id,
+        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp_epoch": time.time(),
+        "user_id": user_id,
+        "conversation_id": conversation_id,
+        "attribute": attribute,
+        "topic": topic,
+        "status": LIVE,
+        # Ids of the facts this one replaced, and of the fact that replaced it.
+        "supersedes": ",".join(supersedes),
+        "superseded_by": "",
+        "version": version
+    }
+    # Chroma rejects None values on add; unknown fields are left out instead.
+    return {key: value for key, value in metadata.items() if value is not None}
+
+_migrated = set()
+_migration_lock = threading.Lock()
+
+def migrate_legacy_documents(collection, property_id: str = DEFAULT_PROPERTY_ID) -> int:
+    """
+    Split the collection's per-attribute documents (written before facts were
+    stored individually) into live fact records, then mark the collection.
+    Migrated ids are derived from the document id, so a migration interrupted
+    or run by two processes at once converges on the same records.
+    """
+    if (collection.metadata or {}).get(FACT_SCHEMA_KEY) == FACT_SCHEMA_VERSION:
+        return 0
+    stored = traced_call("chroma.get", collection.get, include=["documents", "metadatas"])
+    legacy = [
+        (doc_id, document, meta or {})
+        for doc_id, document, meta in zip(stored["ids"], stored["documents"], stored["metadatas"])
+        if "status" not in (meta or {})
+    ]
+    ids, documents, metadatas = [], [], []
+    for doc_id, document, meta in legacy:
+        for i, fact in enumerate(split_facts(document or "")):
+            record = fact_metadata(meta.get("attribute"), "", meta.get("version", 0), meta.get("user_id"),
+                                   meta.get("conversation_id"), property_id)
+            record.update(timestamp=meta.get("timestamp", record["timestamp"]),
+                          timestamp_epoch=meta.get("timestamp_epoch", record["timestamp_epoch"]))
+            ids.append(f"{doc_id}-fact-{i}")
+            documents.append(fact)
+            metadatas.append(record)
+    if ids:
+        traced_call("chroma.upsert", collection.upsert, ids=ids, documents=documents,
+                    metadatas=metadatas, embeddings=embed_texts(documents))
+    if legacy:
+        traced_call("chroma.delete", collection.delete, ids=[doc_id for doc_id, _, _ in legacy])
+        logger.info(f"Split {len(legacy)} legacy document(s) of property '{property_id}' into {len(ids)} facts.")
+    collection.modify(metadata={**(collection.metadata or {}), FACT_SCHEMA_KEY: FACT_SCHEMA_VERSION})
+    return len(ids)
+
+def get_fact_collection(property_id: str = DEFAULT_PROPERTY_ID, create: bool = True):
+    """
+    The property's collection, migrated to fact records on first use in this
+    process. None if it does not exist and `create` is off.
+    """
+    collection = get_property_collection(property_id, create)
+    if collection is not None and property_id not in _migrated:
+        with _migration_lock:
+            if property_id not in _migrated:
+                migrate_legacy_documents(collection, property_id)
+                _migrated.add(property_id)
+    return collection
+
+def live_facts(attribute: str, property_id: str = DEFAULT_PROPERTY_ID) -> list:
+    """[(fact_id, text, metadata)] of the attribute's live facts; a filtered get, no vector search."""
+    collection = get_fact_collection(property_id, create=False)
+    if collection is None:
+        return []
+    result = traced_call(
+        "chroma.get", collection.get,
+        where={"$and": [{"attribute": attribute}, {"status": LIVE}]},
         include=["documents", "metadatas"]
     )
-    docs = results.get("documents", [[]])[0]
-    metadatas = results.get("metadatas", [[]])[0]
-    
-    # Check if there is an existing document with this attribute.
-    for doc, meta in zip(docs, metadatas):
-        if meta.get("attribute") == attribute:
-            doc_id = meta.get("doc_id")
-            logger.info(f"Found existing document for attribute '{attribute}' with doc_id {doc_id}.")
-            if doc_id is None:
-                logger.warning("Document id is missing; skipping candidate.")
-                continue
-            
-            # If the new update is not exactly the same as the stored content:
-            if doc.strip().lower() != new_content.strip().lower():
-                # Call the LLM to merge the existing document with the new update.
-                merged_content = call_openai_merge_info(existing_doc=doc, new_update=new_content)
-                logger.info(f"Merged content: {merged_content}")
-                chroma_collection.update(
-                    ids=[doc_id],
-                    documents=[merged_content],
-                    metadatas=[{
-                        "timestamp": new_ts,
-                        "user_id": user_id,
-                        "conversation_id": conversation_id,
-                        "attribute": attribute,
-                        "doc_id": doc_id
-                    }]
-                )
-                logger.info(f"Updated (merged) document with doc_id {doc_id} for attribute '{attribute}'.")
-                return {"status": "updated", "doc_id": doc_id}
+    return list(zip(result["ids"], result["documents"], result["metadatas"]))
+
+async def label_topic_groups(groups: list) -> list:
+    """
+    Topics for several groups of facts, `groups` being [(texts, known_topics)]
+    with one group per attribute. Facts from many groups share each LLM call
+    of TOPIC_LABEL_BATCH_SIZE facts, each group sent with its known topics;
+    a group split over calls also reuses the topics of its earlier part.
+    Returns one topic list per group, "" for facts that could not be labelled.
+    """
+    results = [[] for _ in groups]
+    known = [{topic for topic in known_topics if topic} for _, known_topics in groups]
+    pending = [(g, text) for g, (texts, _) in enumerate(groups) for text in texts]
+    for start in range(0, len(pending), TOPIC_LABEL_BATCH_SIZE):
+        chunk = OrderedDict()
+        for g, text in pending[start:start + TOPIC_LABEL_BATCH_SIZE]:
+            chunk.setdefault(g, []).append(text)
+        try:
+            labels = await call_openai_label_topics([(sorted(known[g]), texts) for g, texts in chunk.items()])
+        except Exception as e:
+            logger.error(f"Topic labelling failed for {len(pending[start:start + TOPIC_LABEL_BATCH_SIZE])} fact(s): {e}")
+            labels = []
+        for position, (g, texts) in enumerate(chunk.items()):
+            group_labels = labels[position] if position < len(labels) and isinstance(labels[position], list) else []
+            if len(group_labels) != len(texts):
+                logger.warning(f"Topic labelling returned {len(group_labels)} labels for {len(texts)} facts")
+            topics = [normalize_topic(group_labels[i]) if i < len(group_labels) else "" for i in range(len(texts))]
+            results[g] += topics
+            known[g].update(topic for topic in topics if topic)
+    return results
+
+async def label_topics(texts: list, known_topics=()) -> list:
+    """A topic for each text of one attribute, reusing `known_topics` where they fit."""
+    return (await label_topic_groups([(texts, known_topics)]))[0]
+
+async def label_untopiced_facts(attribute, facts, property_id: str = DEFAULT_PROPERTY_ID) -> int:
+    """
+    Give the attribute's live facts that have no topic one, so the topical
+    `facts` about to be written can supersede those that say the same thing.
+    Labels are stored on the records; returns how many were labelled.
+    """
+    incoming = [normalize_topic(fact.get("topic")) for fact in facts]
+    if not any(incoming):
+        return 0
+    live = await asyncio.to_thread(live_facts, attribute, property_id)
+    untopiced = [(live_id, text) for live_id, text, meta in live if not meta.get("topic")]
+    if not untopiced:
+        return 0
+    known = [meta.get("topic") for _, _, meta in live] + incoming
+    topics = await label_topics([text for _, text in untopiced], known)
+    labelled = [(live_id, topic) for (live_id, _), topic in zip(untopiced, topics) if topic]
+    if labelled:
+        await asyncio.to_thread(
+            traced_call, "chroma.update", get_property_collection(property_id).update,
+            ids=[live_id for live_id, _ in labelled],
+            metadatas=[{"topic": topic} for _, topic in labelled]
+        )
+        logger.info(f"Labelled {len(labelled)} topic-less fact(s) of attribute '{attribute}'.")
+    return len(labelled)
+
+def plan_fact_writes(attribute, facts, live=(), user_id=None, conversation_id=None,
+                     property_id=DEFAULT_PROPERTY_ID) -> tuple:
+    """
+    Records to add for `facts` ({"content", "topic"}, oldest first) on top of
+    the `live` facts. A fact supersedes the live facts of its topic, facts
+    without a topic only add to the attribute, and a fact whose text is
+    already live is dropped. Returns ([(fact_id, text, metadata)], {replaced
+    live fact id: new fact id}); metadata versions are filled in on write.
+    """
+    current = {}
+    # Texts of the facts live after the writes so far, by id: a fact retired
+    # earlier in the batch no longer counts as already known.
+    known = {live_id: text.strip().lower() for live_id, text, _ in live}
+    for live_id, _, meta in live:
+        if meta.get("topic"):
+            current.setdefault(meta["topic"], []).append(live_id)
+    records = {}
+    superseded = {}
+    for fact in facts:
+        text = fact["content"].strip()
+        topic = normalize_topic(fact.get("topic"))
+        if not text or text.lower() in known.values():
+            continue
+        new_id = fact_id()
+        known[new_id] = text.lower()
+        replaced = current.get(topic, []) if topic else []
+        for old_id in replaced:
+            known.pop(old_id, None)
+            if old_id in records:
+                # Replaced within the same batch: stored, but never live.
+                records[old_id][1].update(status=SUPERSEDED, superseded_by=new_id)
             else:
-                # If the new update is identical, you might just update the timestamp.
-                chroma_collection.update(
-                    ids=[doc_id],
-                    documents=[doc],
-                    metadatas=[{
-                        "timestamp": new_ts,
-                        "user_id": user_id,
-                        "conversation_id": conversation_id,
-                        "attribute": attribute,
-                        "doc_id": doc_id
-                    }]
-                )
-                logger.info(f"Document for attribute '{attribute}' (doc_id {doc_id}) is already up-to-date.")
-                return {"status": "already_up_to_date", "doc_id": doc_id}
-    
-    # No candidate exists, so add a new document.
-    new_id = f"doc-{datetime.now().timestamp()}"
-    chroma_collection.add(
-        documents=[new_content],
-        metadatas=[{
-            "timestamp": new_ts,
-            "user_id": user_id,
-            "conversation_id": conversation_id,
-            "attribute": attribute,
-            "doc_id": new_id
-        }],
-        ids=[new_id]
+                superseded[old_id] = new_id
+        records[new_id] = (text, fact_metadata(attribute, topic, 0, user_id, conversation_id, property_id,
+                                               supersedes=replaced))
+        if topic:
+            current[topic] = [new_id]
+    return [(new_id, text, meta) for new_id, (text, meta) in records.items()], superseded
+
+async def extract_owner_fact(message, history=None) -> dict:
+    """
+    First phase of an owner update: decide whether the message holds a fact
+    worth saving, which attribute it belongs to and the sub-topic it settles.
+    Returns {"status": "ignored", "reason": ...} or {"attribute": ..., "content": ..., "topic": ...}.
+    """
+    decision = await call_openai_should_save(message, history or [])
+    if decision["action"] == "ignore":
+        logger.info("Owner update ignored: " + decision["reason"])
+        return {"status": "ignored", "reason": decision["reason"]}
+
+    content = decision["content_to_save"]
+    attribute = await determine_attribute(content)
+    return {"attribute": attribute, "content": content, "topic": normalize_topic(decision.get("topic"))}
+
+def base_version(property_id: str, attribute: str, stored_version: int):
+    """
+    The version a write must swap from, or None if another writer holds a
+    ticket it has not written yet.
+    """
+    ticket, taken_at = knowledge_versions.get_with_timestamp(doc_version_key(property_id, attribute))
+    if ticket == stored_version:
+        return stored_version
+    if ticket < stored_version:
+        # Versions table was reset while the facts survived; continue from the table.
+        return ticket
+    if time.time() - taken_at > MERGE_ABANDONED_SECONDS:
+        logger.warning(f"Reclaiming abandoned write ticket {ticket} for attribute '{attribute}'.")
+        return ticket
+    return None
+
+async def try_apply_owner_update(attribute, facts, user_id=None, conversation_id=None,
+                                 property_id=DEFAULT_PROPERTY_ID):
+    """
+    One read -> compare-and-swap -> append + invalidate cycle.
+    Returns the result, or None when another worker wrote the attribute first.
+    """
+    live = await asyncio.to_thread(live_facts, attribute, property_id)
+    # Every write adds a live fact stamped with its ticket, so the newest live
+    # fact carries the attribute's current version.
+    stored_version = max((meta.get("version", 0) for _, _, meta in live), default=0)
+    expected = await asyncio.to_thread(base_version, property_id, attribute, stored_version)
+    if expected is None:
+        return None
+
+    records, superseded = plan_fact_writes(attribute, facts, live, user_id, conversation_id, property_id)
+    if not records:
+        logger.info(f"Attribute '{attribute}' already holds these facts; nothing to write.")
+        return {"status": "already_up_to_date", "fact_ids": [], "superseded": []}
+
+    # Take the next write ticket only if nobody wrote since the read above.
+    version = await asyncio.to_thread(knowledge_versions.compare_and_swap, doc_version_key(property_id, attribute), expected)
+    if version is None:
+        return None
+    for _, _, meta in records:
+        meta["version"] = version
+    collection = get_property_collection(property_id)
+    await asyncio.to_thread(
+        traced_call, "chroma.add", collection.add,
+        ids=[new_id for new_id, _, _ in records],
+        documents=[text for _, text, _ in records],
+        metadatas=[meta for _, _, meta in records]
     )
-    logger.info(f"Added new document with doc_id {new_id} for attribute '{attribute}'.")
-    return {"status": "saved", "doc_id": new_id}
+    if superseded:
+        # Added first, invalidated second: a crash in between leaves an extra
+        # live fact for the next write on the topic to retire, never a gap.
+        await asyncio.to_thread(
+            traced_call, "chroma.update", collection.update,
+            ids=list(superseded),
+            metadatas=[{"status": SUPERSEDED, "superseded_by": new_id, "superseded_at": time.time()}
+                       for new_id in superseded.values()]
+        )
+    # Invalidates cached tenant answers built on the previous facts.
+    await asyncio.to_thread(knowledge_versions.bump, scoped_key(property_id, attribute))
+    status = "updated" if superseded else "saved"
+    logger.info(f"Attribute '{attribute}' is now at version {version}: {len(records)} fact(s) added, "
+                f"{len(superseded)} superseded ({status}).")
+    return {"status": status, "fact_ids": [new_id for new_id, _, _ in records], "superseded": list(superseded)}
+
+async def apply_owner_update(attribute, facts, user_id=None, conversation_id=None,
+                             property_id=DEFAULT_PROPERTY_ID) -> dict:
+    """
+    Second phase: append one or more extracted facts ({"content", "topic"},
+    oldest first) for `attribute` and retire the live facts they replace. The
+    only LLM call labels live facts that have no topic yet, once. Writes to
+    one attribute are serialized in-process by a lock and across workers by
+    compare-and-swap, re-reading when another worker got there first.
+    """
+    logger.info(f"Processing {len(facts)} update(s) for property '{property_id}' attribute '{attribute}': "
+                f"{[fact['content'] for fact in facts]}")
+    async with write_lock(property_id, attribute):
+        await label_untopiced_facts(attribute, facts, property_id)
+        for attempt in range(1, MERGE_MAX_ATTEMPTS + 1):
+            result = await try_apply_owner_update(attribute, facts, user_id, conversation_id, property_id)
+            if result is not None:
+                return result
+            logger.info(f"Write conflict on attribute '{attribute}' (attempt {attempt}); re-reading.")
+            await asyncio.sleep(random.uniform(0.05, 0.2) * attempt)
+    raise MergeConflictError(f"Gave up writing attribute '{attribute}' after {MERGE_MAX_ATTEMPTS} conflicts")
@@ -0,0 +1,103 @@
+# app/services/ranking.py
+import logging
+import math
+import os
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from app.logger import logger
+
+# Weights of similarity (inverted, min-max normalized distance) and recency.
+RANK_ALPHA = float(os.environ.get("RANK_ALPHA", "0.5"))
+RANK_BETA = float(os.environ.get("RANK_BETA", "0.5"))
+# Recency half-life in seconds. 0 keeps min-max normalized timestamps instead
+# of exponential decay.
+RANK_RECENCY_HALF_LIFE = float(os.environ.get("RANK_RECENCY_HALF_LIFE", "0"))
+# MMR trade-off between score and diversity. 1.0 disables MMR.
+RANK_MMR_LAMBDA = float(os.environ.get("RANK_MMR_LAMBDA", "1.0"))
+RANK_TOP_N = int(os.environ.get("RANK_TOP_N", "3"))
+
+
+def metadata_epoch(meta: dict) -> float:
+    """
+    Epoch seconds of a stored document. New documents carry `timestamp_epoch`;
+    older ones only have the naive UTC ISO `timestamp`, parsed as a fallback.
+    """
+    epoch = meta.get("timestamp_epoch")
+    if epoch is not None:
+        return float(epoch)
+    try:
+        return datetime.fromisoformat(meta.get("timestamp")).replace(tzinfo=timezone.utc).timestamp()
+    except Exception:
+        return 0.0
+
+
+def _min_max(values: np.ndarray, flat: float) -> np.ndarray:
+    spread = values.max() - values.min()
+    if spread <= 0:
+        return np.full_like(values, flat)
+    return (values - values.min()) / spread
+
+
+def score_candidates(distances, epochs, alpha: float = RANK_ALPHA, beta: float = RANK_BETA,
+                     half_life: float = RANK_RECENCY_HALF_LIFE, now: float = None) -> np.ndarray:
+    """Hybrid similarity + recency score for every candidate at once."""
+    distances = np.asarray(distances, dtype=np.float64)
+    epochs = np.asarray(epochs, dtype=np.float64)
+    similarity = 1.0 - _min_max(distances, 0.0)
+    if half_life > 0:
+        now = time.time() if now is None else now
+        age = np.maximum(now - epochs, 0.0)
+        recency = np.exp(-math.log(2) * age / half_life)
+    else:
+        recency = _min_max(epochs, 1.0)
+    return alpha * similarity + beta * recency
+
+
+def _mmr_select(scores: np.ndarray, embeddings, top_n: int, mmr_lambda: float) -> list:
+    vectors = np.asarray(embeddings, dtype=np.float64)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    selected = [int(np.argmax(scores))]
+    # Highest similarity of each candidate to anything already selected; only
+    # one row of the similarity matrix is computed per pick.
+    redundancy = vectors @ vectors[selected[0]]
+    available = np.ones(len(scores), dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < top_n and available.any():
+        mmr = mmr_lambda * scores - (1 - mmr_lambda) * redundancy
+        mmr[~available] = -np.inf
+        pick = int(np.argmax(mmr))
+        selected.append(pick)
+        available[pick] = False
+        redundancy = np.maximum(redundancy, vectors @ vectors[pick])
+    return selected
+
+
+def rerank(documents: list, metadatas: list, distances: list, top_n: int = RANK_TOP_N,
+           alpha: float = RANK_ALPHA, beta: float = RANK_BETA,
+           half_life: float = RANK_RECENCY_HALF_LIFE, mmr_lambda: float = RANK_MMR_LAMBDA,
+           embeddings=None, now: float = None) -> list:
+    """
+    Return the best `top_n` candidates as (document, metadata, distance, score)
+    tuples, best first. MMR diversity is applied when `mmr_lambda` < 1 and the
+    candidates' embeddings are supplied.
+    """
+    if not documents:
+        return []
+    epochs = np.fromiter((metadata_epoch(meta) for meta in metadatas), dtype=np.float64, count=len(metadatas))
+    scores = score_candidates(distances, epochs, alpha=alpha, beta=beta, half_life=half_life, now=now)
+    top_n = min(top_n, len(documents))
+
+    if mmr_lambda < 1.0 and embeddings is not None and len(embeddings):
+        order = _mmr_select(scores, embeddings, top_n, mmr_lambda)
+    elif top_n < len(scores):
+        best = np.argpartition(-scores, top_n - 1)[:top_n]
+        order = best[np.argsort(-scores[best])]
+    else:
+        order = np.argsort(-scores)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Re-ranked {len(documents)} candidates; top scores: {scores[order].round(3).tolist()}")
+    return [(documents[i], metadatas[i], distances[i], float(scores[i])) for i in order]
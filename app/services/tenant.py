@@ -0,0 +1,188 @@
+# app/services/tenant.py
+import asyncio
+import os
+
+from app.logger import logger
+from app.core.db import embed_texts, scoped_key, DEFAULT_PROPERTY_ID
+from app.core.versions import knowledge_versions
+from app.core.tracing import traced_call
+from app.helpers.helpers import determine_attribute_from_query, attribute_classifier
+from app.services.answer_cache import answer_cache
+from app.services.knowledge import get_fact_collection, LIVE
+from app.services.ranking import rerank, RANK_MMR_LAMBDA
+from app.core.llm import (
+    call_openai_rag,
+    call_openai_rag_stream,
+    call_openai_should_answer,
+    call_openai_check_relevance,
+    call_openai_route_message,
+    call_openai_answer_with_relevance,
+    TENANT_ROUTER_MODE,
+    TENANT_ANSWER_MODE
+)
+
+# Candidates fetched from Chroma per tenant question, after the attribute filter.
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "10"))
+# Candidate embeddings are only needed for MMR diversity.
+RETRIEVAL_INCLUDE = ["documents", "metadatas", "distances"] + (["embeddings"] if RANK_MMR_LAMBDA < 1.0 else [])
+
+NOT_RELEVANT_REASON = "Retrieved context is not relevant."
+# Query result shape for a property that has no collection yet.
+NO_RESULTS = {"ids": [[]], "documents": [[]], "metadatas": [[]], "distances": [[]], "embeddings": [[]]}
+
+
+async def route_tenant_message(message: str, history_window: dict):
+    """
+    Start the answer decision and resolve the target attribute.
+    Returns (task resolving to a dict with "answer", target attribute).
+    """
+    if TENANT_ROUTER_MODE == "fused":
+        # One call decides both. If the local classifier already knows the
+        # attribute, retrieval can still overlap with the router call.
+        route_task = asyncio.create_task(call_openai_route_message(message, history_window))
+        local_attribute = attribute_classifier.classify_fast(message)
+        if local_attribute is not None:
+            return route_task, local_attribute
+        route = await route_task
+        return route_task, route["attribute"]
+
+    # should_answer is the slowest stage, so start it first and overlap the
+    # attribute inference, cache lookup and retrieval with it.
+    answer_task = asyncio.create_task(call_openai_should_answer(message, history_window))
+    return answer_task, await determine_attribute_from_query(message)
+
+
+async def answer_from_context(message: str, context: str, stream: bool = False):
+    """
+    Relevance check + answer generation. Yields {"event": "token", "text": ...}
+    events while a streamed answer is generated, then one {"event": "outcome",
+    "fields": ...} event with the fields to merge into the response.
+    """
+    if TENANT_ANSWER_MODE == "fused":
+        verdict = await call_openai_answer_with_relevance(query=message, context=context)
+        if verdict.get("is_relevant", False) and verdict.get("answer"):
+            # The fused call returns structured JSON, so the answer arrives in one piece.
+            if stream:
+                yield {"event": "token", "text": verdict["answer"]}
+            yield {"event": "outcome", "fields": {"assistant": verdict["answer"]}}
+        else:
+            yield {"event": "outcome", "fields": {"status": "ignored", "reason": verdict.get("reason", NOT_RELEVANT_REASON)}}
+        return
+
+    relevance_check = await call_openai_check_relevance(query=message, context=context)
+    if not relevance_check.get("is_relevant", False):
+        yield {"event": "outcome", "fields": {"status": "ignored", "reason": relevance_check.get("reason", NOT_RELEVANT_REASON)}}
+        return
+    if stream:
+        yield {"event": "status", "stage": "answering"}
+        parts = []
+        async for token in call_openai_rag_stream(query=message, context=context):
+            parts.append(token)
+            yield {"event": "token", "text": token}
+        assistant_reply = "".join(parts)
+    else:
+        assistant_reply = await call_openai_rag(query=message, context=context)
+    yield {"event": "outcome", "fields": {"assistant": assistant_reply}}
+
+
+async def run_tenant_pipeline(message: str, history_window: dict, stream: bool = False,
+                              property_id: str = DEFAULT_PROPERTY_ID):
+    """
+    The tenant question pipeline, over the property's own facts only, as a stream of events:
+      {"event": "status", "stage": "checking" | "retrieving" | "answering"}
+      {"event": "token", "text": ...}            (only when `stream` is set)
+      {"event": "outcome", "fields": {...}}      (last; fields to merge into the response)
+    """
+    yield {"event": "status", "stage": "checking"}
+    answer_task, target_attribute = await route_tenant_message(message, history_window)
+    # Versions and cached answers are per property and attribute.
+    knowledge_key = scoped_key(property_id, target_attribute)
+    try:
+        # Reads never create a collection; a property without one has no facts.
+        collection = await asyncio.to_thread(get_fact_collection, property_id, False)
+        # The knowledge version is read before retrieval, so a cached answer is
+        # never stamped with a version newer than the facts it was built from.
+        knowledge_version = await asyncio.to_thread(knowledge_versions.get, knowledge_key)
+        query_vector = (await asyncio.to_thread(embed_texts, [message]))[0]
+
+        # Reuse the answer to a near-identical question if the facts for this
+        # attribute have not changed since; otherwise retrieve only the live
+        # facts for the target attribute, filtered inside Chroma.
+        cached = answer_cache.get(knowledge_key, knowledge_version, query_vector)
+        if cached is None and collection is None:
+            results = NO_RESULTS
+        elif cached is None:
+            yield {"event": "status", "stage": "retrieving"}
+            logger.info(f"Retrieving documents for attribute: {target_attribute}")
+            results = await asyncio.to_thread(
+                traced_call, "chroma.query", collection.query,
+                query_embeddings=[query_vector],
+                n_results=RETRIEVAL_TOP_K,
+                where={"$and": [{"attribute": target_attribute}, {"status": LIVE}]},
+                include=RETRIEVAL_INCLUDE
+            )
+        decision = await answer_task
+        if not decision.get("answer", False):
+            yield {"event": "outcome", "fields": {}}
+            return
+
+        if cached is not None:
+            logger.info(f"Answer cache hit for attribute '{target_attribute}'")
+            if stream and cached.get("assistant"):
+                yield {"event": "token", "text": cached["assistant"]}
+            yield {"event": "outcome", "fields": cached}
+            return
+
+        # If nothing is stored for the attribute, fall back to all documents.
+        # Answers built from other attributes' documents are not cached, since
+        # their versions are not tracked by the cache key.
+        cacheable = bool(results["ids"][0])
+        if not cacheable and collection is not None:
+            logger.warning(f"No documents stored for attribute '{target_attribute}'. Falling back to all documents.")
+            results = await asyncio.to_thread(
+                traced_call, "chroma.query", collection.query,
+                query_embeddings=[query_vector],
+                n_results=RETRIEVAL_TOP_K,
+                where={"status": LIVE},
+                include=RETRIEVAL_INCLUDE
+            )
+        if not results["ids"][0]:
+            logger.warning(f"No candidate documents match attribute '{target_attribute}'.")
+            yield {"event": "outcome", "fields": {
+                "status": "ignored",
+                "reason": f"No documents available for attribute '{target_attribute}'."
+            }}
+            return
+
+        # Hybrid similarity + recency scoring (and optional MMR diversity), vectorized.
+        top_candidates = rerank(
+            results.get("documents", [[]])[0],
+            results.get("metadatas", [[]])[0],
+            results.get("distances", [[]])[0],
+            embeddings=results["embeddings"][0] if RANK_MMR_LAMBDA < 1.0 else None
+        )
+
+        # Combine these documents into a context string (with appropriate separators)
+        combined_context = "\n\n".join(
+            f"{doc.strip()} (added on {meta.get('timestamp', 'unknown')})"
+            for doc, meta, _, _ in top_candidates
+        )
+        logger.debug(f"Combined context for RAG:\n{combined_context}")
+
+        async for event in answer_from_context(message, combined_context, stream=stream):
+            if event["event"] == "outcome" and cacheable:
+                answer_cache.put(knowledge_key, knowledge_version, query_vector, event["fields"])
+            yield event
+    finally:
+        # Don't leave the decision call running if the client went away mid-stream.
+        answer_task.cancel()
+
+
+async def answer_tenant_message(message: str, history_window: dict,
+                                property_id: str = DEFAULT_PROPERTY_ID) -> dict:
+    """Non-streaming form of the pipeline: returns the fields to merge into the response."""
+    fields = {}
+    async for event in run_tenant_pipeline(message, history_window, property_id=property_id):
+        if event["event"] == "outcome":
+            fields = event["fields"]
+    return fields
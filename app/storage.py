@@ -1,17 +1,385 @@
-import os
+import asyncio
 import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from app.logger import logger
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms
+    fcntl = None
 
 STORAGE_DIR = "data/conversations"
+# "file" (append-only log + offset index) or "sqlite" (single WAL database).
+STORAGE_BACKEND = os.environ.get("CONVERSATION_BACKEND", "file").lower()
+
+# History window sent to the LLM: the rolling summary plus the turns it does
+# not cover, which are kept to about N turns and K tokens.
+HISTORY_MAX_TURNS = int(os.environ.get("HISTORY_MAX_TURNS", "10"))
+HISTORY_MAX_TOKENS = int(os.environ.get("HISTORY_MAX_TOKENS", "1000"))
+# Turns that fall out of the window are folded into the rolling summary in
+# batches of this size rather than on every message.
+HISTORY_SUMMARY_BATCH = int(os.environ.get("HISTORY_SUMMARY_BATCH", "10"))
+# Hard cap on unsummarized turns in the window (and per summary refresh), for
+# when the summarizer falls behind.
+HISTORY_MAX_UNSUMMARIZED_TURNS = int(os.environ.get("HISTORY_MAX_UNSUMMARIZED_TURNS", "60"))
+# Summaries kept in memory per process; the least recently used are dropped.
+HISTORY_SUMMARY_CACHE_SIZE = int(os.environ.get("HISTORY_SUMMARY_CACHE_SIZE", "1000"))
+# Most turns returned by one history delta; older ones are skipped and the
+# delta is marked truncated.
+HISTORY_DELTA_MAX_TURNS = int(os.environ.get("HISTORY_DELTA_MAX_TURNS", "200"))
 
 os.makedirs(STORAGE_DIR, exist_ok=True)
 
-def save_conversation(user_id, content: str):
-    with open(f"{STORAGE_DIR}/{user_id}.txt", "w", encoding="utf-8") as f:
-        f.write(content)
+# One index entry per record: byte offset into the log and record length.
+_INDEX_ENTRY = struct.Struct("<QI")
+
+
+class _ConversationLocks:
+    """Hands out one lock per conversation so appends to the same thread are serialized."""
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}
+
+    def get(self, conversation_id) -> threading.Lock:
+        with self._guard:
+            lock = self._locks.get(conversation_id)
+            if lock is None:
+                lock = self._locks[conversation_id] = threading.Lock()
+            return lock
+
+
+class FileConversationStore:
+    """
+    Append-only conversation log with an on-disk offset index.
+
+    `{id}.log` holds the records back to back and `{id}.idx` holds one
+    fixed-width (offset, length) entry per record, so appending is O(1) and
+    any range of records can be read with two seeks whatever the history length.
+    Bytes written to the log without a matching index entry (e.g. after a
+    crash) are never referenced and are simply skipped.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._locks = _ConversationLocks()
+
+    def _paths(self, conversation_id):
+        base = os.path.join(self.directory, conversation_id)
+        return f"{base}.log", f"{base}.idx", f"{base}.txt"
+
+    def _migrate_legacy(self, conversation_id):
+        """Import a pre-existing whole-file transcript (`{id}.txt`) into the log once."""
+        log_path, idx_path, legacy_path = self._paths(conversation_id)
+        if os.path.exists(idx_path) or not os.path.exists(legacy_path):
+            return
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            entries = [line for line in f.read().split("\n") if line.strip()]
+        for entry in entries:
+            self._append_locked(conversation_id, entry)
+        os.replace(legacy_path, f"{legacy_path}.migrated")
+
+    def _append_locked(self, conversation_id, entry: str) -> int:
+        log_path, idx_path, _ = self._paths(conversation_id)
+        data = entry.encode("utf-8")
+        with open(log_path, "ab") as log, open(idx_path, "ab") as idx:
+            if fcntl is not None:
+                # Serializes appends across worker processes as well.
+                fcntl.flock(log.fileno(), fcntl.LOCK_EX)
+            try:
+                offset = log.seek(0, os.SEEK_END)
+                log.write(data + b"\n")
+                log.flush()
+                idx.write(_INDEX_ENTRY.pack(offset, len(data)))
+                idx.flush()
+                return idx.tell() // _INDEX_ENTRY.size
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(log.fileno(), fcntl.LOCK_UN)
+
+    def append(self, conversation_id, entry: str) -> int:
+        """Append one record and return the new record count."""
+        with self._locks.get(conversation_id):
+            self._migrate_legacy(conversation_id)
+            return self._append_locked(conversation_id, entry)
+
+    def count(self, conversation_id) -> int:
+        with self._locks.get(conversation_id):
+            self._migrate_legacy(conversation_id)
+        _, idx_path, _ = self._paths(conversation_id)
+        if not os.path.exists(idx_path):
+            return 0
+        return os.path.getsize(idx_path) // _INDEX_ENTRY.size
+
+    def read_range(self, conversation_id, start: int, stop: int = None) -> list:
+        """Return records `start` (inclusive) to `stop` (exclusive) using the index."""
+        total = self.count(conversation_id)
+        stop = total if stop is None else min(stop, total)
+        start = max(start, 0)
+        if start >= stop:
+            return []
+        log_path, idx_path, _ = self._paths(conversation_id)
+        with open(idx_path, "rb") as idx:
+            idx.seek(start * _INDEX_ENTRY.size)
+            raw = idx.read((stop - start) * _INDEX_ENTRY.size)
+        entries = [_INDEX_ENTRY.unpack_from(raw, i) for i in range(0, len(raw), _INDEX_ENTRY.size)]
+        with open(log_path, "rb") as log:
+            first = entries[0][0]
+            log.seek(first)
+            last_offset, last_length = entries[-1]
+            blob = log.read(last_offset + last_length - first)
+        return [blob[offset - first:offset - first + length].decode("utf-8") for offset, length in entries]
+
+
+class SQLiteConversationStore:
+    """Conversation store backed by a single SQLite database in WAL mode."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._locks = _ConversationLocks()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " conversation_id TEXT NOT NULL,"
+            " seq INTEGER NOT NULL,"
+            " entry TEXT NOT NULL,"
+            " PRIMARY KEY (conversation_id, seq))"
+        )
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections are not shareable across threads, and the
+        # request handlers call us from a thread pool.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def append(self, conversation_id, entry: str) -> int:
+        with self._locks.get(conversation_id):
+            conn = self._conn()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                (seq,) = conn.execute(
+                    "SELECT COALESCE(MAX(seq), -1) + 1 FROM messages WHERE conversation_id = ?",
+                    (conversation_id,),
+                ).fetchone()
+                conn.execute(
+                    "INSERT INTO messages (conversation_id, seq, entry) VALUES (?, ?, ?)",
+                    (conversation_id, seq, entry),
+                )
+            return seq + 1
+
+    def count(self, conversation_id) -> int:
+        (total,) = self._conn().execute(
+            "SELECT COUNT(*) FROM messages WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()
+        return total
 
-def load_conversation(user_id) -> str:
-    path = f"{STORAGE_DIR}/{user_id}.txt"
-    if os.path.exists(path):
+    def read_range(self, conversation_id, start: int, stop: int = None) -> list:
+        stop = self.count(conversation_id) if stop is None else stop
+        rows = self._conn().execute(
+            "SELECT entry FROM messages WHERE conversation_id = ? AND seq >= ? AND seq < ? ORDER BY seq",
+            (conversation_id, max(start, 0), stop),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+
+if STORAGE_BACKEND == "sqlite":
+    conversation_store = SQLiteConversationStore(os.path.join(STORAGE_DIR, "conversations.db"))
+else:
+    conversation_store = FileConversationStore(STORAGE_DIR)
+
+
+def new_turn(role: str, text: str) -> dict:
+    return {"id": uuid.uuid4().hex, "role": role, "text": text, "ts": round(time.time(), 3)}
+
+def encode_turn(turn: dict) -> str:
+    """One compact JSON line; newlines inside the text are escaped, so records never split."""
+    return json.dumps(turn, ensure_ascii=False, separators=(",", ":"))
+
+def parse_entry(entry: str) -> dict:
+    """
+    A stored record as a turn dict {"id", "role", "text", "ts"}. Records
+    written before turns were JSON are "[ROLE] text" lines, with no id or time.
+    """
+    if entry.startswith("{"):
+        try:
+            return json.loads(entry)
+        except ValueError:
+            pass
+    if entry.startswith("[") and "] " in entry:
+        role, text = entry[1:].split("] ", 1)
+        return {"id": None, "role": role.lower(), "text": text, "ts": None}
+    return {"id": None, "role": "unknown", "text": entry, "ts": None}
+
+def llm_turn(turn: dict) -> dict:
+    """The part of a turn the LLM prompts need."""
+    return {"role": turn["role"], "text": turn["text"]}
+
+def append_turn(conversation_id, role: str, text: str) -> tuple:
+    """Record a turn; returns (turn, new turn count), the count being the cursor after it."""
+    turn = new_turn(role, text)
+    return turn, conversation_store.append(conversation_id, encode_turn(turn))
+
+def load_turns_since(conversation_id, cursor: int, total: int = None) -> dict:
+    """
+    The turns after `cursor` (the number of turns the client already has),
+    at most HISTORY_DELTA_MAX_TURNS of the newest, and the cursor to send next.
+    """
+    total = conversation_store.count(conversation_id) if total is None else total
+    cursor = min(max(cursor, 0), total)
+    start = max(cursor, total - HISTORY_DELTA_MAX_TURNS)
+    return {
+        "turns": [parse_entry(e) for e in conversation_store.read_range(conversation_id, start, total)],
+        "cursor": total,
+        "truncated": start > cursor,
+    }
+
+def estimate_tokens(text: str) -> int:
+    # Rough 4-characters-per-token estimate; good enough for budgeting a prompt.
+    return len(text) // 4 + 1
+
+
+class HistorySummaries:
+    """
+    Rolling summaries of the turns that have scrolled out of the history window.
+
+    Each conversation keeps `{id}.summary.json` with the summary text and the
+    number of leading turns it covers. Refreshing only feeds the previous
+    summary plus the newly evicted turns to the summarizer, so the cost per
+    refresh is bounded by the batch size rather than the conversation length.
+    """
+
+    def __init__(self, directory: str, max_cached: int = HISTORY_SUMMARY_CACHE_SIZE):
+        self.directory = directory
+        self.max_cached = max_cached
+        # conversation id -> (file mtime, record), least recently used first.
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    def _path(self, conversation_id):
+        return os.path.join(self.directory, f"{conversation_id}.summary.json")
+
+    def _remember(self, conversation_id, mtime, record):
+        with self._lock:
+            self._cache[conversation_id] = (mtime, record)
+            self._cache.move_to_end(conversation_id)
+            while len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+
+    def get(self, conversation_id) -> dict:
+        """
+        The stored summary. The file's mtime is checked on every call, so a
+        summary written by another worker is picked up on the next read.
+        """
+        path = self._path(conversation_id)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return {"summary": "", "covered": 0}
+        with self._lock:
+            cached = self._cache.get(conversation_id)
+            if cached is not None and cached[0] == mtime:
+                self._cache.move_to_end(conversation_id)
+                return cached[1]
         with open(path, "r", encoding="utf-8") as f:
-            return f.read()
-    return ""
+            record = json.load(f)
+        self._remember(conversation_id, mtime, record)
+        return record
+
+    def _put(self, conversation_id, summary: str, covered: int):
+        record = {"summary": summary, "covered": covered}
+        path = self._path(conversation_id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+        self._remember(conversation_id, os.stat(path).st_mtime_ns, record)
+
+    async def refresh(self, conversation_id, summarize, max_turns: int = None, max_tokens: int = None):
+        """
+        Fold the oldest unsummarized turns into the summary once they exceed
+        the window (see fold_point). `summarize(previous_summary, turns)` is
+        an async callable returning the new summary.
+        """
+        if conversation_id in self._refreshing:
+            return
+        self._refreshing.add(conversation_id)
+        try:
+            current = await asyncio.to_thread(self.get, conversation_id)
+            covered = current["covered"]
+            total = await asyncio.to_thread(conversation_store.count, conversation_id)
+            if total - covered > HISTORY_MAX_UNSUMMARIZED_TURNS:
+                # Far behind (e.g. the summarizer was down): catch up one bounded slice at a time.
+                stop = covered + HISTORY_MAX_UNSUMMARIZED_TURNS
+                entries = await asyncio.to_thread(conversation_store.read_range, conversation_id, covered, stop)
+                turns = [llm_turn(parse_entry(e)) for e in entries]
+            else:
+                entries = await asyncio.to_thread(conversation_store.read_range, conversation_id, covered, total)
+                turns = [llm_turn(parse_entry(e)) for e in entries]
+                turns = turns[:fold_point(turns, max_turns, max_tokens)]
+            if not turns:
+                return
+            summary = await summarize(current["summary"], turns)
+            latest = await asyncio.to_thread(self.get, conversation_id)
+            if latest["covered"] != covered:
+                # Another worker folded these turns meanwhile; keep its summary.
+                return
+            await asyncio.to_thread(self._put, conversation_id, summary, covered + len(turns))
+        except Exception as e:
+            # The previous summary stays valid; the next message retries the refresh.
+            logger.error(f"History summary refresh failed for {conversation_id}: {e}")
+        finally:
+            self._refreshing.discard(conversation_id)
+
+
+def fold_point(turns: list, max_turns: int = None, max_tokens: int = None) -> int:
+    """
+    How many of the oldest unsummarized `turns` to fold into the summary now.
+    Nothing until they exceed `max_turns` by a full HISTORY_SUMMARY_BATCH or
+    exceed `max_tokens`; then everything but the newest turns fitting in
+    `max_turns` and half of `max_tokens`, so the next fold is a batch away.
+    """
+    max_turns = HISTORY_MAX_TURNS if max_turns is None else max_turns
+    max_tokens = HISTORY_MAX_TOKENS if max_tokens is None else max_tokens
+    costs = [estimate_tokens(turn["text"]) for turn in turns]
+    if len(turns) - max_turns < HISTORY_SUMMARY_BATCH and sum(costs) <= max_tokens:
+        return 0
+    kept, budget = 0, max_tokens // 2
+    for cost in reversed(costs[len(costs) - max_turns:] if max_turns > 0 else []):
+        if kept and cost > budget:
+            break
+        kept += 1
+        budget -= cost
+    return len(turns) - kept
+
+
+history_summaries = HistorySummaries(STORAGE_DIR)
+
+
+def load_history_window(conversation_id) -> dict:
+    """
+    Return the history sent to the LLM: the cached rolling summary plus every
+    turn it does not cover yet, newest last. The summary refresh after each
+    message keeps those turns within roughly HISTORY_MAX_TURNS and
+    HISTORY_MAX_TOKENS (plus a batch), so no turn is ever in neither.
+    """
+    current = history_summaries.get(conversation_id)
+    total = conversation_store.count(conversation_id)
+    # Bounded even if the summarizer keeps failing; older turns wait for it to catch up.
+    start = max(current["covered"], total - HISTORY_MAX_UNSUMMARIZED_TURNS)
+    turns = [llm_turn(parse_entry(e)) for e in conversation_store.read_range(conversation_id, start, total)]
+    return {"summary": current["summary"], "turns": turns}
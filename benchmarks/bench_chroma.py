@@ -0,0 +1,105 @@
+"""
+Chroma query latency as a property's collection grows.
+
+Fills a scratch collection with deterministic vectors (spread over the six
+attributes, a quarter of them superseded) up to each size and times the
+tenant retrieval query, with and without the live-facts-of-one-attribute
+filter that app/services/tenant.py applies:
+
+    python benchmarks/bench_chroma.py [--sizes 100 1000 10000 100000] [--queries 200] [--dim 256]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chromadb import PersistentClient  # noqa: E402
+
+from app.helpers.classifier import ALLOWED_ATTRIBUTES  # noqa: E402
+
+ADD_BATCH = 5000
+# Fact statuses as stored by app/services/knowledge.py (not imported: it
+# needs OpenAI credentials at import time).
+LIVE = "live"
+SUPERSEDED = "superseded"
+# Every SUPERSEDED_EVERY-th fact of each attribute has been replaced by a newer one.
+SUPERSEDED_EVERY = 4
+
+
+def retrieval_filter(attribute: str) -> dict:
+    """The where clause of the tenant retrieval query."""
+    return {"$and": [{"attribute": attribute}, {"status": LIVE}]}
+
+
+def fill(collection, start: int, stop: int, dim: int, rng):
+    attributes = list(ALLOWED_ATTRIBUTES)
+    now = time.time()
+    for offset in range(start, stop, ADD_BATCH):
+        ids = range(offset, min(offset + ADD_BATCH, stop))
+        vectors = rng.standard_normal((len(ids), dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        collection.add(
+            ids=[f"doc-{i}" for i in ids],
+            embeddings=vectors,
+            documents=[f"fact {i}" for i in ids],
+            metadatas=[
+                {
+                    "attribute": attributes[i % len(attributes)],
+                    "status": SUPERSEDED if i // len(attributes) % SUPERSEDED_EVERY == SUPERSEDED_EVERY - 1 else LIVE,
+                    "timestamp_epoch": now - i,
+                }
+                for i in ids
+            ],
+        )
+
+
+def time_queries(collection, queries: np.ndarray, where=None) -> np.ndarray:
+    timings = []
+    for vector in queries:
+        started = time.perf_counter()
+        collection.query(
+            query_embeddings=[vector],
+            n_results=10,
+            where=where,
+            include=["documents", "metadatas", "distances"],
+        )
+        timings.append(time.perf_counter() - started)
+    return np.array(timings) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=256)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    queries = rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    print(f"{'docs':>8} {'fill s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'filtered p50':>13} {'p95':>8} {'p99':>8}")
+    with tempfile.TemporaryDirectory(prefix="rentizy-chroma-") as scratch:
+        collection = PersistentClient(path=scratch).create_collection("bench", embedding_function=None)
+        size = 0
+        for target in sorted(args.sizes):
+            started = time.perf_counter()
+            fill(collection, size, target, args.dim, rng)
+            fill_time = time.perf_counter() - started
+            size = target
+            plain = time_queries(collection, queries)
+            filtered = time_queries(collection, queries, where=retrieval_filter("amenities"))
+            print(f"{size:>8} {fill_time:>8.1f} "
+                  f"{np.percentile(plain, 50):>8.2f} {np.percentile(plain, 95):>8.2f} {np.percentile(plain, 99):>8.2f} "
+                  f"{np.percentile(filtered, 50):>13.2f} {np.percentile(filtered, 95):>8.2f} "
+                  f"{np.percentile(filtered, 99):>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
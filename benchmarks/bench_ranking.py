@@ -0,0 +1,85 @@
+"""
+Micro-benchmark for the candidate re-ranker.
+
+Compares app.services.ranking.rerank against the per-candidate Python loop it
+replaced, for growing candidate counts:
+
+    python benchmarks/bench_ranking.py [--sizes 10 100 1000] [--repeat 200]
+"""
+import argparse
+import os
+import sys
+import time
+import timeit
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.ranking import rerank  # noqa: E402
+
+
+def make_candidates(n: int, dim: int = 64, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    now = time.time()
+    epochs = now - rng.uniform(0, 90 * 86400, size=n)
+    documents = [f"document {i}" for i in range(n)]
+    metadatas = [
+        {"timestamp": datetime.utcfromtimestamp(t).isoformat(), "timestamp_epoch": float(t)}
+        for t in epochs
+    ]
+    distances = rng.uniform(0.2, 1.6, size=n).tolist()
+    embeddings = rng.standard_normal((n, dim)).astype(np.float32)
+    return documents, metadatas, distances, embeddings
+
+
+def legacy_rerank(documents, metadatas, distances, top_n=3):
+    """The scoring loop formerly inlined in handle_message, minus its logging."""
+    candidates = list(zip(documents, metadatas, distances))
+    min_dist, max_dist = min(distances), max(distances)
+    normalize_distance = lambda x: (x - min_dist) / (max_dist - min_dist) if (max_dist - min_dist) > 0 else 0
+    times = []
+    for _, meta, _ in candidates:
+        try:
+            times.append(datetime.fromisoformat(meta.get("timestamp")).timestamp())
+        except Exception:
+            times.append(0)
+    min_time, max_time = min(times), max(times)
+    normalize_time = lambda t: (t - min_time) / (max_time - min_time) if (max_time - min_time) > 0 else 1
+    scored = []
+    for doc, meta, dist in candidates:
+        try:
+            doc_time = datetime.fromisoformat(meta.get("timestamp")).timestamp()
+        except Exception:
+            doc_time = 0
+        scored.append((0.5 * (1 - normalize_distance(dist)) + 0.5 * normalize_time(doc_time), (doc, meta, dist)))
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return [item[1] for item in scored[:top_n]]
+
+
+def per_call_us(fn, repeat: int) -> float:
+    return min(timeit.repeat(fn, number=repeat, repeat=3)) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500, 1000])
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'candidates':>10} {'legacy µs':>12} {'rerank µs':>12} {'decay µs':>12} {'mmr µs':>12}")
+    for n in args.sizes:
+        documents, metadatas, distances, embeddings = make_candidates(n)
+        legacy = per_call_us(lambda: legacy_rerank(documents, metadatas, distances), args.repeat)
+        vectorized = per_call_us(lambda: rerank(documents, metadatas, distances), args.repeat)
+        decay = per_call_us(lambda: rerank(documents, metadatas, distances, half_life=7 * 86400), args.repeat)
+        mmr = per_call_us(
+            lambda: rerank(documents, metadatas, distances, mmr_lambda=0.7, embeddings=embeddings, top_n=5),
+            args.repeat,
+        )
+        print(f"{n:>10} {legacy:>12.1f} {vectorized:>12.1f} {decay:>12.1f} {mmr:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
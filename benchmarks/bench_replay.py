@@ -0,0 +1,207 @@
+"""
+Replay a recorded conversation trace against the FastAPI app, offline.
+
+OpenAI is replaced by benchmarks/fake_openai.py (configurable latency,
+deterministic embeddings) and every store is created in a scratch directory,
+so a run costs nothing and starts from the same state each time. Requests go
+through httpx's ASGI transport, without a server. Reports requests/sec,
+client-side latency per role, and p50/p95/p99 per pipeline stage from the
+app's own tracing histograms:
+
+    python benchmarks/bench_replay.py [--trace benchmarks/traces/sample.jsonl]
+        [--speed 0] [--concurrency 16] [--chat-latency lognormal:0.6:0.4]
+        [--embedding-latency const:0.05] [--stream] [--json results.json]
+
+Trace lines are JSON objects: {"at": seconds, "role", "user_id", "property_id", "message"}.
+--speed 1 replays at recorded pace, 2 twice as fast, 0 as fast as --concurrency allows.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+DEFAULT_TRACE = os.path.join(ROOT, "benchmarks", "traces", "sample.jsonl")
+PERCENTILES = (0.5, 0.95, 0.99)
+
+
+def load_trace(path: str, repeat: int) -> list:
+    with open(path, encoding="utf-8") as fh:
+        events = [json.loads(line) for line in fh if line.strip()]
+    span = max((e.get("at", 0.0) for e in events), default=0.0)
+    replay = []
+    for round_ in range(repeat):
+        for event in events:
+            replay.append(dict(event, at=event.get("at", 0.0) + round_ * span))
+    return replay
+
+
+def histogram_quantile(q: float, bounds: tuple, counts: list, total: int) -> float:
+    """Quantile estimate from cumulative bucket counts, interpolating inside the bucket."""
+    if total == 0:
+        return float("nan")
+    rank = q * total
+    lower, below = 0.0, 0
+    for bound, cumulative in zip(bounds, counts):
+        if cumulative >= rank:
+            inside = cumulative - below
+            return lower + (bound - lower) * ((rank - below) / inside if inside else 0.0)
+        lower, below = bound, cumulative
+    return bounds[-1]
+
+
+def stage_report(before: dict, after: dict, bounds: tuple) -> dict:
+    """Per-stage percentiles of the observations made between two histogram snapshots."""
+    report = {}
+    for (stage, status), series in sorted(after.items()):
+        previous = before.get((stage, status), {"counts": [0] * len(bounds), "count": 0, "sum": 0.0})
+        count = series["count"] - previous["count"]
+        if count == 0:
+            continue
+        counts = [a - b for a, b in zip(series["counts"], previous["counts"])]
+        report[f"{stage} [{status}]"] = {
+            "count": count,
+            "mean": (series["sum"] - previous["sum"]) / count,
+            **{f"p{int(q * 100)}": histogram_quantile(q, bounds, counts, count) for q in PERCENTILES},
+        }
+    return report
+
+
+async def send(client, event: dict, stream: bool) -> float:
+    body = {k: event[k] for k in ("message", "role", "user_id", "property_id") if k in event}
+    started = time.perf_counter()
+    if stream:
+        async with client.stream("POST", "/api/send/stream", json=body) as response:
+            async for _ in response.aiter_raw():
+                pass
+    else:
+        response = await client.post("/api/send", json=body)
+    response.raise_for_status()
+    return time.perf_counter() - started
+
+
+async def wait_for_jobs(job_queue, timeout: float) -> float:
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        counts = job_queue.counts()
+        if not any(counts.get(status) for status in ("queued", "running", "ready", "merging")):
+            break
+        await asyncio.sleep(0.05)
+    return time.perf_counter() - started
+
+
+async def replay(args) -> dict:
+    import httpx
+    import main
+    from app.core.tracing import stage_latency, LATENCY_BUCKETS
+    from app.services.jobs import job_queue
+    from benchmarks.fake_openai import install
+
+    for name in (None, "chat-assistant"):
+        logging.getLogger(name).setLevel(args.log_level.upper())
+    fakes = install(args.chat_latency, args.embedding_latency, args.seed)
+    events = load_trace(args.trace, args.repeat)
+    latencies = {}
+    errors = 0
+
+    async with main.app.router.lifespan_context(main.app):
+        while not getattr(main.app.state, "ready", False):
+            await asyncio.sleep(0.05)
+        before = stage_latency.snapshot()
+        limit = asyncio.Semaphore(args.concurrency)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            started = time.perf_counter()
+
+            async def run(event):
+                nonlocal errors
+                if args.speed > 0:
+                    await asyncio.sleep(max(0.0, started + event["at"] / args.speed - time.perf_counter()))
+                async with limit:
+                    try:
+                        latency = await send(client, event, args.stream)
+                    except Exception as e:
+                        errors += 1
+                        print(f"request failed: {e}", file=sys.stderr)
+                        return
+                latencies.setdefault(event["role"], []).append(latency)
+
+            await asyncio.gather(*(run(event) for event in events))
+            elapsed = time.perf_counter() - started
+        drain = await wait_for_jobs(job_queue, args.job_timeout)
+        after = stage_latency.snapshot()
+
+    total = sum(len(v) for v in latencies.values())
+    return {
+        "requests": total,
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "requests_per_second": total / elapsed if elapsed else 0.0,
+        "owner_job_drain_seconds": drain,
+        "llm_calls": fakes["chat"].calls,
+        "embedding_calls": fakes["embedding"].calls,
+        "client_latency": {
+            role: {f"p{int(q * 100)}": float(np.quantile(values, q)) for q in PERCENTILES}
+            for role, values in sorted(latencies.items())
+        },
+        "stages": stage_report(before, after, LATENCY_BUCKETS),
+    }
+
+
+def print_report(result: dict):
+    print(f"requests      {result['requests']} ({result['errors']} errors) in {result['elapsed_seconds']:.2f} s"
+          f" -> {result['requests_per_second']:.1f} req/s")
+    print(f"owner jobs    drained {result['owner_job_drain_seconds']:.2f} s after the last response")
+    print(f"remote calls  {result['llm_calls']} chat, {result['embedding_calls']} embedding batches")
+    print()
+    print(f"{'client latency':<40} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for role, row in result["client_latency"].items():
+        print(f"{role:<40} {row['p50'] * 1e3:>9.1f} {row['p95'] * 1e3:>9.1f} {row['p99'] * 1e3:>9.1f}")
+    print()
+    print(f"{'stage':<40} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage, row in result["stages"].items():
+        print(f"{stage:<40} {row['count']:>6} {row['p50'] * 1e3:>9.1f} {row['p95'] * 1e3:>9.1f} {row['p99'] * 1e3:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trace", default=DEFAULT_TRACE)
+    parser.add_argument("--repeat", type=int, default=1, help="replay the trace this many times back to back")
+    parser.add_argument("--speed", type=float, default=0.0)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--chat-latency", default="lognormal:0.6:0.4")
+    parser.add_argument("--embedding-latency", default="const:0.05")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stream", action="store_true", help="use /api/send/stream")
+    parser.add_argument("--job-timeout", type=float, default=120.0)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--log-level", default="warning")
+    args = parser.parse_args()
+    args.trace = os.path.abspath(args.trace)
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    # Every replayed request comes from one client address; measure the pipeline, not the limiter.
+    os.environ.setdefault("RATE_LIMIT_USER_PER_MINUTE", "0")
+    os.environ.setdefault("RATE_LIMIT_IP_PER_MINUTE", "0")
+    with tempfile.TemporaryDirectory(prefix="rentizy-bench-") as scratch:
+        # Every store uses paths relative to the working directory.
+        os.chdir(scratch)
+        result = asyncio.run(replay(args))
+        os.chdir(ROOT)
+
+    print_report(result)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as fh:
+            json.dump(result, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
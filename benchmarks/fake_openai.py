@@ -0,0 +1,199 @@
+"""
+Local stand-in for the OpenAI API, for benchmarks that must not spend money.
+
+Chat completions answer every prompt the app sends with a plausible, valid
+reply (JSON where the caller parses JSON), after a delay drawn from a
+configurable latency distribution. Embeddings are deterministic unit vectors
+seeded from a hash of the normalized text, so identical texts embed
+identically across runs and the caches behave as they would in production.
+
+    from benchmarks.fake_openai import install
+    install(chat_latency="lognormal:0.8:0.4", embedding_latency="const:0.05")
+
+Latency specs: "const:S", "uniform:LO:HI", "lognormal:MEDIAN:SIGMA" (seconds).
+"""
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import types
+
+import numpy as np
+
+from app.helpers.classifier import LEXICON, DEFAULT_ATTRIBUTE
+
+EMBEDDING_DIM = 256
+SMALL_TALK = {"ok", "okay", "thanks", "thank you", "hi", "hello", "great", "cool", "bye"}
+
+
+class LatencyModel:
+    """Samples call latencies in seconds from a parsed spec."""
+
+    def __init__(self, kind: str = "const", params=(0.0,), seed: int = 0):
+        self.kind = kind
+        self.params = tuple(float(p) for p in params)
+        self._rng = random.Random(seed)
+
+    @classmethod
+    def parse(cls, spec: str, seed: int = 0) -> "LatencyModel":
+        kind, *params = spec.split(":")
+        expected = {"const": 1, "uniform": 2, "lognormal": 2}
+        if kind not in expected or len(params) != expected[kind]:
+            raise ValueError(f"Bad latency spec {spec!r}; use const:S, uniform:LO:HI or lognormal:MEDIAN:SIGMA")
+        return cls(kind, params, seed)
+
+    def sample(self) -> float:
+        if self.kind == "const":
+            return self.params[0]
+        if self.kind == "uniform":
+            return self._rng.uniform(*self.params)
+        median, sigma = self.params
+        return median * self._rng.lognormvariate(0.0, sigma)
+
+
+def fake_embed(texts, dim: int = EMBEDDING_DIM) -> list:
+    vectors = []
+    for text in texts:
+        seed = int.from_bytes(hashlib.sha1(" ".join(text.lower().split()).encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+        vectors.append(vector / np.linalg.norm(vector))
+    return vectors
+
+
+def guess_attribute(text: str) -> str:
+    lowered = text.lower()
+    for attribute, words in LEXICON.items():
+        if any(word in lowered for word in words):
+            return attribute
+    return DEFAULT_ATTRIBUTE
+
+
+def guess_topic(text: str) -> str:
+    """The first lexicon keyword in the text, so facts about the same thing supersede each other."""
+    lowered = text.lower()
+    for words in LEXICON.values():
+        for word in words:
+            if word in lowered:
+                return word.replace(" ", "_")
+    return ""
+
+
+def is_question(text: str) -> bool:
+    lowered = text.strip().lower()
+    return lowered.endswith("?") or bool(re.match(r"^(is|are|do|does|can|how|what|where|when|which|who|any)\b", lowered))
+
+
+def reply_for(messages: list, response_format: dict = None) -> str:
+    """The content a reasonable model would return for one of the app's prompts."""
+    system = messages[0]["content"]
+    user = messages[-1]["content"]
+    schema = ((response_format or {}).get("json_schema") or {}).get("name")
+
+    if schema == "tenant_route":
+        message = json.loads(user)["message"]
+        return json.dumps({"answer": is_question(message), "attribute": guess_attribute(message), "reason": "fake"})
+    if schema == "tenant_answer":
+        return json.dumps({"is_relevant": True, "reason": "fake", "answer": "According to the listing, yes."})
+    if "message from the PROPERTY OWNER" in system:
+        message = json.loads(user)["current_message"]
+        if message.strip().lower().strip("!.") in SMALL_TALK:
+            return json.dumps({"action": "ignore", "reason": "small talk", "content_to_save": "", "topic": ""})
+        return json.dumps({"action": "save", "reason": "fact", "content_to_save": message, "topic": guess_topic(message)})
+    if "processed using RAG" in system:
+        return json.dumps({"answer": is_question(json.loads(user)["message"]), "reason": "fake"})
+    if "SPECIFICALLY relevant" in system:
+        return json.dumps({"is_relevant": True, "reason": "fake", "topic_mentioned": True})
+    if "label facts about a rental property" in system:
+        groups = json.loads(user)["groups"]
+        return json.dumps({"topics": [
+            [guess_topic(fact) or "_".join(fact.lower().split()[:3]) for fact in group["facts"]] for group in groups
+        ]})
+    if "For each numbered sentence" in system:
+        sentences = re.findall(r"^\d+\. (.*)$", user, flags=re.M)
+        return json.dumps({"labels": [guess_attribute(sentence) for sentence in sentences]})
+    if "categorizes property-related text" in system:
+        return guess_attribute(user)
+    if "running summary" in system:
+        return "Earlier the tenant and owner discussed the property."
+    return "According to the listing, yes. Let me know if you need anything else."
+
+
+def _usage(messages: list, content: str):
+    prompt = sum(len(m["content"]) for m in messages) // 4
+    completion = len(content) // 4
+    return types.SimpleNamespace(prompt_tokens=prompt, completion_tokens=completion, total_tokens=prompt + completion)
+
+
+class _Completions:
+    def __init__(self, owner):
+        self._owner = owner
+
+    async def create(self, model=None, messages=None, stream=False, response_format=None, **kwargs):
+        self._owner.calls += 1
+        content = reply_for(messages, response_format)
+        delay = self._owner.chat_latency.sample()
+        if stream:
+            return self._stream(model, messages, content, delay)
+        await asyncio.sleep(delay)
+        return types.SimpleNamespace(
+            model=model,
+            choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content))],
+            usage=_usage(messages, content),
+        )
+
+    async def _stream(self, model, messages, content, delay):
+        # A third of the latency before the first token, the rest spread over the tokens.
+        words = content.split(" ")
+        await asyncio.sleep(delay / 3)
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(delay * 2 / 3 / len(words))
+            token = word if i == len(words) - 1 else word + " "
+            yield types.SimpleNamespace(
+                model=model, usage=None,
+                choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=token))],
+            )
+        yield types.SimpleNamespace(model=model, choices=[], usage=_usage(messages, content))
+
+
+class FakeAsyncOpenAI:
+    """Drop-in for the parts of openai.AsyncOpenAI the app uses."""
+
+    def __init__(self, chat_latency: LatencyModel = None):
+        self.chat_latency = chat_latency or LatencyModel()
+        self.calls = 0
+        self.chat = types.SimpleNamespace(completions=_Completions(self))
+
+
+class FakeOpenAI:
+    """Drop-in for the embeddings part of the synchronous openai.OpenAI client."""
+
+    def __init__(self, latency: LatencyModel = None, dim: int = EMBEDDING_DIM):
+        self.latency = latency or LatencyModel()
+        self.dim = dim
+        self.calls = 0
+        self.embeddings = types.SimpleNamespace(create=self.create_embeddings)
+
+    def create_embeddings(self, model=None, input=None, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency.sample())
+        return types.SimpleNamespace(
+            model=model,
+            data=[types.SimpleNamespace(embedding=vector.tolist()) for vector in fake_embed(input, self.dim)],
+        )
+
+
+def install(chat_latency: str = "const:0", embedding_latency: str = "const:0", seed: int = 0) -> dict:
+    """
+    Swap the fakes in underneath the app's shared OpenAI clients, so requests
+    still go through their pooling, retry and circuit-breaker logic.
+    """
+    from app.core import openai_client
+
+    chat = FakeAsyncOpenAI(LatencyModel.parse(chat_latency, seed))
+    embedding = FakeOpenAI(LatencyModel.parse(embedding_latency, seed + 1))
+    openai_client.async_client.inner = chat
+    openai_client.sync_client.inner = embedding
+    return {"chat": chat, "embedding": embedding}
@@ -1,31 +1,75 @@
 from chromadb import logger
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
-from datetime import datetime
-from app.helpers.helpers import determine_attribute_from_query
-from app.core.db import conversation_collection  # Shared Chroma collection instance.
-from app.storage import load_conversation, save_conversation
-from app.core.llm import (
-    call_openai_rag,
-    call_openai_should_save,
-    call_openai_should_answer,
-    call_openai_check_relevance
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
+import json
+import math
+import re
+import time
+import uuid
+from contextlib import asynccontextmanager
+import asyncio
+from app.helpers.helpers import attribute_classifier
+from app.core.db import get_embedding_function, warm_up, is_valid_property_id, DEFAULT_PROPERTY_ID  # Shared Chroma store.
+from app.core.tracing import stage_latency, register_collector, render_prometheus
+from app.core import openai_client, request_guard
+from app.core.request_guard import (
+    retry_after, request_key, send_coalescer, IdempotencyKeyReused, OriginalRequestFailed
 )
+from app.logger import trace_id_var
+from app.services.answer_cache import answer_cache
+from app.services.tenant import answer_tenant_message, run_tenant_pipeline
+from app.storage import load_history_window, append_turn, load_turns_since, history_summaries
+from app.core.llm import call_openai_summarize_history
+from app.services.jobs import owner_workers, job_queue, submit_owner_message, job_status
+from app.services.bulk_import import parse_listing_sheet, run_import, import_status
 
-from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction
-import chromadb
 from dotenv import load_dotenv
-import os
 load_dotenv()
-# Setup Chroma client
-chroma_client = chromadb.PersistentClient(path="./chroma")
-collection = chroma_client.get_or_create_collection(
-    name="support_conversations",
-    embedding_function=OpenAIEmbeddingFunction(api_key=os.environ.get("OPENAI_API_KEY"))
-)
 
-app = FastAPI()
+# Backoff between warm-up attempts: doubles from the first delay up to the cap.
+WARM_UP_FIRST_RETRY_SECONDS = 1.0
+WARM_UP_MAX_RETRY_SECONDS = 60.0
+
+async def warm_until_done(name: str, step):
+    """Run a blocking warm-up step off the request path, retrying with backoff until it succeeds."""
+    delay = WARM_UP_FIRST_RETRY_SECONDS
+    while True:
+        try:
+            await asyncio.to_thread(step)
+            logger.info(f"Warm-up of the {name} complete")
+            return
+        except Exception as e:
+            # Requests still initialize lazily meanwhile.
+            logger.error(f"Warm-up of the {name} failed, retrying in {delay:g}s: {e}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, WARM_UP_MAX_RETRY_SECONDS)
+
+async def warm_store():
+    """
+    Open the shared Chroma store, then embed the classifier examples. Ready
+    once the store is open: the classifier falls back to the LLM until its
+    embeddings are in, so an embedding outage does not hold readiness back.
+    """
+    await warm_until_done("store", warm_up)
+    app.state.ready = True
+    await warm_until_done("classifier", attribute_classifier.warm_up)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready = False
+    # Warm in the background so the server starts accepting connections (and
+    # /ready can report progress) while the store loads.
+    warm_task = asyncio.create_task(warm_store())
+    # Owner messages are processed from the durable job queue; jobs left
+    # unfinished by a previous run are picked up again once their lease expires.
+    owner_workers.start()
+    yield
+    warm_task.cancel()
+    await owner_workers.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 # Enable CORS for frontend
 app.add_middleware(
@@ -36,143 +80,324 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # Every log line and stage timing in this request carries the same trace id.
+    trace_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+    token = trace_id_var.set(trace_id)
+    started = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        response.headers["X-Trace-Id"] = trace_id
+        return response
+    finally:
+        route = request.scope.get("route")
+        stage = f"request {route.path}" if route is not None else "request unmatched"
+        stage_latency.observe(time.perf_counter() - started, stage=stage, status=status)
+        trace_id_var.reset(token)
+
+def collect_cache_events():
+    embedding = get_embedding_function().stats()
+    classifier = attribute_classifier.stats()
+    answers = answer_cache.stats()
+    return [
+        ({"cache": "embedding", "result": "memory_hit"}, embedding["memory_hits"]),
+        ({"cache": "embedding", "result": "disk_hit"}, embedding["disk_hits"]),
+        ({"cache": "embedding", "result": "miss"}, embedding["misses"]),
+        ({"cache": "attribute", "result": "memo_hit"}, classifier["memo"]),
+        ({"cache": "attribute", "result": "lexicon_hit"}, classifier["lexicon"]),
+        ({"cache": "attribute", "result": "centroid_hit"}, classifier["centroid"]),
+        ({"cache": "attribute", "result": "miss"}, classifier["llm"]),
+        ({"cache": "answer", "result": "hit"}, answers["hits"]),
+        ({"cache": "answer", "result": "miss"}, answers["misses"]),
+    ]
+
+register_collector("rentizy_cache_events_total", "Cache lookups by cache and outcome.", collect_cache_events, "counter")
+register_collector(
+    "rentizy_openai_events_total",
+    "OpenAI client retries, fallbacks, circuit rejections and final failures.",
+    lambda: [({"event": event}, count) for event, count in openai_client.stats()["events"].items()],
+    "counter"
+)
+register_collector(
+    "rentizy_openai_circuit_open",
+    "1 while the circuit breaker for a model is open.",
+    lambda: [({"model": model}, state) for model, state in openai_client.stats()["open_circuits"].items()]
+)
+register_collector(
+    "rentizy_send_requests_total",
+    "Send requests rejected by the rate limits, or answered from another request's pipeline run.",
+    lambda: [({"outcome": f"limited_{scope}"}, count) for scope, count in request_guard.stats()["limited"].items()]
+            + [({"outcome": outcome}, request_guard.stats()[outcome]) for outcome in ("coalesced", "replayed")],
+    "counter"
+)
+register_collector(
+    "rentizy_owner_jobs",
+    "Owner knowledge jobs by status.",
+    lambda: [({"status": status}, count) for status, count in job_queue.counts().items()]
+)
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
 @app.get("/")
 def get_chat_ui():
     return FileResponse("static/chat_interface.html")
 
-def get_last_n_messages(history_str, n=5):
-    lines = [line.strip() for line in history_str.strip().split('\n') if line.strip()]
-    return lines[-n:]
+@app.get("/ready")
+def readiness():
+    if not getattr(app.state, "ready", False):
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    return {"status": "ready"}
 
-@app.post("/api/send")
-async def handle_message(request: Request):
-    data = await request.json()
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight.
+background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# User ids name history files, and contain no "." so the property separator
+# below is unambiguous.
+USER_ID_PATTERN = re.compile(r"^[A-Za-z0-9_@+-]{1,128}$")
+
+def is_valid_user_id(user_id) -> bool:
+    return isinstance(user_id, str) and bool(USER_ID_PATTERN.match(user_id))
+
+def conversation_id_for(user_id: str, property_id: str) -> str:
+    """
+    Property first, then ".", which neither a property id nor a user id can
+    contain, so different (property, user) pairs never share a conversation.
+    """
+    if property_id == DEFAULT_PROPERTY_ID:
+        return f"conv-{user_id}"
+    return f"conv-{property_id}.{user_id}"
+
+def parse_cursor(value):
+    """A client's history cursor (turns it already has), or None if absent or malformed."""
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+async def prepare_message(data: dict):
+    """
+    Validate a chat message, record it and load the history the pipeline needs.
+    Returns None for invalid input.
+    """
     message = data.get("message", "").strip()
     role = data.get("role", "").lower()
     user_id = data.get("user_id")
+    # Listing the conversation is about; facts and retrieval are scoped to it.
+    property_id = data.get("property_id") or DEFAULT_PROPERTY_ID
 
-    if not message or not role or not user_id:
+    if not message or not role or not is_valid_user_id(user_id) or not is_valid_property_id(property_id):
+        return None
+
+    conversation_id = conversation_id_for(user_id, property_id)
+    # Bounded view of the history (rolling summary + last turns) for the LLM calls.
+    history_window = await asyncio.to_thread(load_history_window, conversation_id)
+    turn, total = await asyncio.to_thread(append_turn, conversation_id, role, message)
+    # The response carries only the turns after the client's cursor (by
+    # default just this one), never the whole transcript.
+    cursor = parse_cursor(data.get("cursor"))
+    delta = await asyncio.to_thread(load_turns_since, conversation_id, total - 1 if cursor is None else cursor, total)
+    # Fold turns that scrolled out of the window into the summary off the request path.
+    run_in_background(history_summaries.refresh(conversation_id, call_openai_summarize_history))
+
+    return {
+        "message": message,
+        "role": role,
+        "user_id": user_id,
+        "property_id": property_id,
+        "conversation_id": conversation_id,
+        "history_window": history_window,
+        "response_data": {"status": "ok", "message_id": turn["id"], "history": delta},
+    }
+
+async def handle_owner_message(prepared: dict):
+    # Owner messages are acknowledged right away and stored as facts in the knowledge
+    # base by the job workers; progress is at /api/jobs/{job_id}.
+    job_id = await submit_owner_message(
+        message=prepared["message"],
+        history=prepared["history_window"]["turns"],
+        user_id=prepared["user_id"],
+        conversation_id=prepared["conversation_id"],
+        property_id=prepared["property_id"]
+    )
+    prepared["response_data"]["queued"] = True
+    prepared["response_data"]["job_id"] = job_id
+
+@app.get("/api/history")
+async def get_history(user_id: str, property_id: str = DEFAULT_PROPERTY_ID, cursor: int = 0):
+    """Turns of the conversation after `cursor`, and the cursor to pass next time."""
+    if not is_valid_user_id(user_id) or not is_valid_property_id(property_id):
+        return JSONResponse(status_code=400, content={"error": "Invalid input"})
+    return await asyncio.to_thread(load_turns_since, conversation_id_for(user_id, property_id), cursor)
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    status = await asyncio.to_thread(job_status, job_id)
+    if status is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown job"})
+    return status
+
+@app.post("/api/import")
+async def import_listings(request: Request):
+    """
+    Bulk import of owner facts from a listing sheet:
+    {"format": "csv" | "json" | "text", "content": "...", "property_id": ..., "user_id": ...}.
+    Runs in the background; progress is at /api/import/{import_id}.
+    """
+    data = await request.json()
+    property_id = data.get("property_id") or DEFAULT_PROPERTY_ID
+    content = data.get("content") or ""
+    fmt = data.get("format", "text")
+    user_id = data.get("user_id")
+    if (not isinstance(content, str) or not isinstance(fmt, str) or not content.strip()
+            or not is_valid_property_id(property_id) or (user_id is not None and not is_valid_user_id(user_id))):
+        return JSONResponse(status_code=400, content={"error": "Invalid input"})
+    try:
+        facts = parse_listing_sheet(content, fmt, property_id)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    if not facts:
+        return JSONResponse(status_code=400, content={"error": "No facts found"})
+
+    properties = len({pid for pid, _ in facts})
+    import_id = await asyncio.to_thread(import_status.create, len(facts), properties)
+    run_in_background(run_import(import_id, facts, user_id=user_id))
+    return {"import_id": import_id, "status": "running", "total_facts": len(facts), "properties": properties}
+
+@app.get("/api/import/{import_id}")
+async def get_import(import_id: str):
+    status = await asyncio.to_thread(import_status.get, import_id)
+    if status is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown import"})
+    return status
+
+def too_many_requests(wait: float) -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        content={"error": "Too many requests", "retry_after": math.ceil(wait)},
+        headers={"Retry-After": str(math.ceil(wait))}
+    )
+
+KEY_REUSED = {"error": "Idempotency-Key was already used for a different request"}
+ORIGINAL_FAILED = {"error": "The original request did not complete; retry"}
+
+async def process_message(data: dict) -> dict:
+    prepared = await prepare_message(data)
+    if prepared is None:
         return {"error": "Invalid input"}
+    response_data = prepared["response_data"]
+
+    if prepared["role"] == "tenant":
+        response_data.update(await answer_tenant_message(
+            prepared["message"], prepared["history_window"], property_id=prepared["property_id"]
+        ))
+    elif prepared["role"] == "owner":
+        await handle_owner_message(prepared)
+    return response_data
 
-    conversation_id = f"conv-{user_id}"
-    chat_history_text = load_conversation(conversation_id)
-    timestamp = datetime.utcnow().isoformat()
-    entry = f"[{role.upper()}] {message}"
-    updated_history = f"{chat_history_text}\n{entry}".strip()
-    save_conversation(conversation_id, updated_history)
-    
-    response_data = {"status": "ok", "history": updated_history}
-
-    if role == "tenant":
-        decision = call_openai_should_answer(message, chat_history_text)
-        if decision.get("answer", False):
-# After retrieving documents from Chroma:
-            results = conversation_collection.query(
-                query_texts=[message],
-                n_results=10,
-                include=["documents", "metadatas", "distances"]
-            )
-            documents = results.get("documents", [[]])[0]
-            metadatas = results.get("metadatas", [[]])[0]
-            distances = results.get("distances", [[]])[0]
-
-            # Determine the target attribute from the query:
-            target_attribute = determine_attribute_from_query(message)
-            logger.info(f"Filtering documents for attribute: {target_attribute}")
-
-            # Filter candidates with metadata attribute equal to target:
-            filtered_candidates = []
-            for doc, meta, dist in zip(documents, metadatas, distances):
-                doc_attr = meta.get("attribute", "general")
-                logger.info(f"Candidate: attribute={doc_attr}, timestamp={meta.get('timestamp')}, distance={dist}")
-                if doc_attr == target_attribute:
-                    filtered_candidates.append((doc, meta, dist))
-
-            # If no candidate matching the attribute, fallback to all candidates.
-            if not filtered_candidates:
-                logger.warning(f"No candidate documents match attribute '{target_attribute}'. Falling back to all candidates.")
-                # Here the fallback is still "all candidates"
-                filtered_candidates = list(zip(documents, metadatas, distances))
-            
-            # Assume filtered_candidates is a list of tuples: (doc, meta, distance)
-            if not filtered_candidates:
-                logger.warning(f"No candidate documents match attribute '{target_attribute}'.")
-                # Handle the error or return a message indicating no stored information
-                response_data["status"] = "ignored"
-                response_data["reason"] = f"No documents available for attribute '{target_attribute}'."
-                return JSONResponse(content=response_data)
-
-            # Compute normalized scores for each candidate (similar to your previous code)
-            current_epoch = datetime.utcnow().timestamp()
-            candidate_distances = [cand[2] for cand in filtered_candidates]
-            min_dist = min(candidate_distances) if candidate_distances else 0
-            max_dist = max(candidate_distances) if candidate_distances else 0
-            normalize_distance = lambda x: (x - min_dist) / (max_dist - min_dist) if (max_dist - min_dist) > 0 else 0
-
-            candidate_times = []
-            for _, meta, _ in filtered_candidates:
-                try:
-                    ts = datetime.fromisoformat(meta.get("timestamp")).timestamp()
-                except Exception:
-                    ts = 0
-                candidate_times.append(ts)
-            min_time = min(candidate_times) if candidate_times else current_epoch
-            max_time = max(candidate_times) if candidate_times else current_epoch
-            normalize_time = lambda t: (t - min_time) / (max_time - min_time) if (max_time - min_time) > 0 else 1
-
-            alpha = 0.5  # weight for similarity (inverted distance)
-            beta = 0.5   # weight for recency
-
-            scored_candidates = []
-            for cand in filtered_candidates:
-                doc, meta, dist = cand
-                norm_dist = normalize_distance(dist)
-                try:
-                    doc_time = datetime.fromisoformat(meta.get("timestamp")).timestamp()
-                except Exception:
-                    doc_time = 0
-                norm_time = normalize_time(doc_time)
-                final_score = alpha * (1 - norm_dist) + beta * norm_time
-                scored_candidates.append((final_score, cand))
-                logger.info(f"Candidate score: final_score={final_score:.3f}, norm_distance={norm_dist:.3f}, norm_time={norm_time:.3f}")
-
-            # Sort the candidates by final score in descending order
-            scored_candidates.sort(key=lambda x: x[0], reverse=True)
-
-            # Choose the top 3 candidates (or fewer if less are available)
-            top_n = 3
-            top_candidates = [item[1] for item in scored_candidates[:top_n]]
-            for idx, (doc, meta, dist) in enumerate(top_candidates):
-                logger.info(f"Top candidate {idx+1}: {doc.strip()} (added on {meta.get('timestamp', 'unknown')})")
-
-            # Combine these documents into a context string (with appropriate separators)
-            combined_context = "\n\n".join(
-                f"{doc.strip()} (added on {meta.get('timestamp', 'unknown')})"
-                for doc, meta, _ in top_candidates
-            )
-
-            logger.info(f"Combined context for RAG:\n{combined_context}")
-
-            # Pass the combined context to your LLM call for generating the answer.
-            relevance_check = call_openai_check_relevance(query=message, context=combined_context)
-            if relevance_check.get("is_relevant", False):
-                assistant_reply = call_openai_rag(query=message, context=combined_context)
-                response_data["assistant"] = assistant_reply
-            else:
-                response_data["status"] = "ignored"
-                response_data["reason"] = relevance_check.get("reason", "Retrieved context is not relevant.")
-
-            return JSONResponse(content=response_data)
-
-    # In the owner branch we process messages via upsert (see below)
-    elif role == "owner":
-        from app.services.knowledge import process_owner_message
-        result = process_owner_message(
-            message=message,
-            history=chat_history_text,
-            user_id=user_id,
-            conversation_id=conversation_id
+@app.post("/api/send")
+async def handle_message(request: Request):
+    """
+    Rate limited per client IP and user_id (429 with Retry-After). A repeated
+    request (same Idempotency-Key header, or the same message from the same
+    user moments later) shares the first one's pipeline run and response,
+    marked with an Idempotent-Replayed header, instead of running it again.
+    If the request it waited on fails or is abandoned, the repeat gets 409.
+    """
+    data = await request.json()
+    wait = retry_after(request, data.get("user_id"))
+    if wait:
+        return too_many_requests(wait)
+    key, fingerprint, ttl = request_key(request, data)
+    try:
+        response_data, shared = await send_coalescer.run(key, fingerprint, lambda: process_message(data), ttl)
+    except IdempotencyKeyReused:
+        return JSONResponse(status_code=422, content=KEY_REUSED)
+    except OriginalRequestFailed:
+        return JSONResponse(status_code=409, content=ORIGINAL_FAILED)
+    return JSONResponse(content=response_data, headers={"Idempotent-Replayed": "true"} if shared else None)
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/api/send/stream")
+async def handle_message_stream(request: Request):
+    """
+    Same as /api/send, as Server-Sent Events: "status" events while the tenant
+    pipeline runs, "token" events as the answer is generated, then one "result"
+    event carrying the response /api/send would have returned. Same rate limits;
+    a repeated request gets only the "result" event of the first one.
+    """
+    data = await request.json()
+    wait = retry_after(request, data.get("user_id"))
+    if wait:
+        return too_many_requests(wait)
+    key, fingerprint, ttl = request_key(request, data)
+    state, entry = send_coalescer.lookup(key)
+    if state is not None:
+        try:
+            response_data = await send_coalescer.wait(state, entry, fingerprint)
+        except IdempotencyKeyReused:
+            return JSONResponse(status_code=422, content=KEY_REUSED)
+        except OriginalRequestFailed:
+            return JSONResponse(status_code=409, content=ORIGINAL_FAILED)
+        return StreamingResponse(
+            iter([sse_event("result", response_data)]),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "Idempotent-Replayed": "true"}
         )
-        response_data["saved"] = (result["status"] in ["saved", "updated"])
 
-    return JSONResponse(content=response_data)
\ No newline at end of file
+    pending = send_coalescer.begin(key, fingerprint)
+    try:
+        prepared = await prepare_message(data)
+    except BaseException as e:
+        send_coalescer.fail(key, pending, e if isinstance(e, Exception) else RuntimeError("Request was cancelled"))
+        raise
+    if prepared is None:
+        send_coalescer.fail(key, pending, ValueError("Invalid input"))
+        return JSONResponse(status_code=400, content={"error": "Invalid input"})
+    response_data = prepared["response_data"]
+
+    async def events():
+        finished = False
+        try:
+            if prepared["role"] == "tenant":
+                async for event in run_tenant_pipeline(prepared["message"], prepared["history_window"],
+                                                       stream=True, property_id=prepared["property_id"]):
+                    if event["event"] == "status":
+                        yield sse_event("status", {"stage": event["stage"]})
+                    elif event["event"] == "token":
+                        yield sse_event("token", {"text": event["text"]})
+                    elif event["event"] == "outcome":
+                        response_data.update(event["fields"])
+            elif prepared["role"] == "owner":
+                await handle_owner_message(prepared)
+            send_coalescer.finish(key, pending, response_data, ttl)
+            finished = True
+            yield sse_event("result", response_data)
+        finally:
+            if not finished:
+                # Client went away or the pipeline failed: repeats must run again.
+                send_coalescer.fail(key, pending, RuntimeError("Request did not complete"))
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Keep proxies from buffering the stream.
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # If the client left before events() started, its finally never runs;
+        # this releases the in-flight entry then (and is a no-op otherwise).
+        background=BackgroundTask(send_coalescer.fail, key, pending, RuntimeError("Request did not complete"))
+    )
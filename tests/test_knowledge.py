@@ -0,0 +1,28 @@
+# tests/test_knowledge.py
+from app.services.knowledge import plan_fact_writes, fact_metadata, LIVE, SUPERSEDED
+
+
+def live_fact(fact_id, text, topic):
+    return fact_id, text, fact_metadata("price", topic)
+
+
+def test_restating_a_retired_value_in_the_same_batch_keeps_it_live():
+    live = [live_fact("L", "Rent is 900 per month.", "monthly_rent")]
+    facts = [
+        {"content": "Rent is 1000 per month.", "topic": "monthly_rent"},
+        {"content": "Rent is 900 per month.", "topic": "monthly_rent"},
+    ]
+    records, superseded = plan_fact_writes("price", facts, live)
+
+    ids = {text: fact_id for fact_id, text, _ in records}
+    statuses = {text: meta["status"] for _, text, meta in records}
+    assert statuses == {"Rent is 1000 per month.": SUPERSEDED, "Rent is 900 per month.": LIVE}
+    assert superseded == {"L": ids["Rent is 1000 per month."]}
+
+
+def test_a_fact_that_is_still_live_is_not_written_again():
+    live = [live_fact("L", "Rent is 900 per month.", "monthly_rent")]
+    records, superseded = plan_fact_writes(
+        "price", [{"content": "rent is 900 per month.", "topic": "monthly_rent"}], live
+    )
+    assert records == [] and superseded == {}